@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+microbenchmark: @api serialization of 1k-row model lists, old masking +
+json.dumps(default=...) vs restful_api_dumps with each available encoder
+'''
+
+import json
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'www'))
+
+import logging
+logging.disable(logging.WARNING)
+
+from transwarp.web import Page, restful_api_dumps, set_json_encoder, _page_dump, _json_encoder
+from models import User, Blog
+
+ROWS = 1000
+
+def _users():
+    now = time.time()
+    return [ User(id='%050d' % n, email='user%d@example.com' % n, password='5f4dcc3b5aa765d61d8327deb882cf99', admin=False, name=u'User %d' % n, image='http://www.gravatar.com/avatar/%d' % n, created_at=now - n) for n in range(ROWS) ]
+
+def _blogs():
+    now = time.time()
+    return [ Blog(id='%050d' % n, user_id='%050d' % 0, user_name=u'Admin', user_image='about:blank', title=u'Blog %d' % n, summary=u'Summary ' * 10, content=u'Content of blog. ' * 50, version=1, created_at=now - n) for n in range(ROWS) ]
+
+def _legacy_dumps(key, rows, mask):
+    # what api_user_list used to do: mutate every row, then dump
+    for r in rows:
+        if mask:
+            r.password = '******'
+    return json.dumps({key: rows, 'page': Page(ROWS, 1, ROWS)}, default=_page_dump)
+
+def main():
+    encoders = []
+    for name in ('json', 'simplejson', 'ujson'):
+        try:
+            _json_encoder(name)
+            encoders.append(name)
+        except ImportError:
+            pass
+    cases = [('users', _users(), True), ('blogs', _blogs(), False)]
+    number = 20
+    print '%-8s %-12s %12s %10s' % ('rows', 'encoder', 'time (ms)', 'size')
+    for key, rows, mask in cases:
+        t = timeit.timeit(lambda: _legacy_dumps(key, rows, mask), number=number)
+        print '%-8s %-12s %12.2f %10d' % (key, 'legacy', t * 1e3 / number, len(_legacy_dumps(key, rows, mask)))
+        for name in encoders:
+            set_json_encoder(name)
+            obj = {key: rows, 'page': Page(ROWS, 1, ROWS)}
+            t = timeit.timeit(lambda: restful_api_dumps(obj), number=number)
+            print '%-8s %-12s %12.2f %10d' % (key, name, t * 1e3 / number, len(restful_api_dumps(obj)))
+
+if __name__ == '__main__':
+    main()
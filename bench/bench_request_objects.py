@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+microbenchmark: per-request cost of Request/Response objects as the
+framework and a typical handler use them, and of a full WSGI round trip;
+run it on two checkouts to compare
+'''
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'www'))
+
+import logging
+logging.disable(logging.WARNING)
+
+from transwarp.web import Request, Response, WSGIApplication, ctx, get, interceptor
+
+# environ as sent through nginx by a browser
+ENVIRON = {
+    'REQUEST_METHOD': 'GET',
+    'PATH_INFO': '/blog/001412345678901234567890',
+    'QUERY_STRING': 'page=2',
+    'SERVER_NAME': 'localhost',
+    'SERVER_PORT': '9000',
+    'SERVER_PROTOCOL': 'HTTP/1.1',
+    'REMOTE_ADDR': '127.0.0.1',
+    'HTTP_HOST': 'www.example.com',
+    'HTTP_CONNECTION': 'keep-alive',
+    'HTTP_USER_AGENT': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_2) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/34.0.1847.131 Safari/537.36',
+    'HTTP_ACCEPT': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'HTTP_ACCEPT_ENCODING': 'gzip,deflate,sdch',
+    'HTTP_ACCEPT_LANGUAGE': 'zh-CN,zh;q=0.8,en;q=0.6',
+    'HTTP_COOKIE': 'awesession=0014123456789012-1400000000-0123456789abcdef0123456789abcdef; _ga=GA1.2.123456789.1400000000',
+    'HTTP_X_REAL_IP': '10.0.0.1',
+    'HTTP_X_FORWARDED_FOR': '10.0.0.1',
+    'wsgi.url_scheme': 'http',
+}
+
+def request_cycle():
+    # router, interceptors and handler accesses of one request
+    r = Request(dict(ENVIRON))
+    r.request_method
+    r.path_info
+    r.path_info
+    r.path_info
+    r.cookie('awesession')
+    r.cookies.get('_ga')
+    r.header('Accept-Encoding')
+    r.header('X-Real-IP')
+    r.header('If-None-Match')
+    r.get('page')
+    res = Response()
+    res.content_type = 'text/html; charset=utf-8'
+    res.set_header('ETag', '"abc"')
+    res.header('Content-Encoding')
+    res.header('Content-Length')
+    return res.headers
+
+def main():
+    @interceptor('/')
+    def f1(next):
+        ctx.request.cookie('awesession')
+        return next()
+    @interceptor('/manage/')
+    def f2(next):
+        return next()
+    @get('/blog/:id')
+    def blog(id):
+        return 'blog %s' % id
+    app = WSGIApplication('/tmp')
+    app.add_interceptor(f1)
+    app.add_interceptor(f2)
+    app.add_url(blog)
+    wsgi = app.get_wsgi_application()
+    def wsgi_cycle():
+        return wsgi(dict(ENVIRON), lambda status, headers: None)
+    number = 50000
+    for name, fn in (('objects', request_cycle), ('wsgi', wsgi_cycle)):
+        t = min(timeit.repeat(fn, number=number, repeat=3))
+        print '%-10s %8.2f us/request' % (name, t * 1e6 / number)
+
+if __name__ == '__main__':
+    main()
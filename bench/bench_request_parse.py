@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+microbenchmark: Request body parsing vs the former cgi.FieldStorage parser
+'''
+
+import cgi
+import os
+import sys
+import timeit
+
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'www'))
+
+from transwarp.web import Request, MultipartFile, _to_unicode
+
+def _field_storage_input(environ):
+    '''
+    Request._parse_input as it was before the parser layer
+    '''
+    def _convert(item):
+        if isinstance(item, list):
+            return [ _to_unicode(i.value) for i in item ]
+        if item.filename:
+            return MultipartFile(item)
+        return _to_unicode(item.value)
+    
+    fs = cgi.FieldStorage(fp=environ['wsgi.input'], environ=environ, keep_blank_values=True)
+    inputs = dict()
+    for key in fs:
+        inputs[key] = _convert(fs[key])
+    return inputs
+
+def _environ(content_type, body):
+    return {
+        'REQUEST_METHOD': 'POST',
+        'QUERY_STRING': '',
+        'CONTENT_TYPE': content_type,
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': StringIO(body),
+    }
+
+def _multipart(size):
+    b = '----transwarpbenchboundary'
+    L = [
+        '--%s' % b, 'Content-Disposition: form-data; name="title"', '', 'Hello',
+        '--%s' % b, 'Content-Disposition: form-data; name="file"; filename="a.bin"', 'Content-Type: application/octet-stream', '', 'x' * size,
+        '--%s--' % b, '',
+    ]
+    return 'multipart/form-data; boundary=%s' % b, '\r\n'.join(L)
+
+def main():
+    cases = [
+        ('urlencoded', 'application/x-www-form-urlencoded', 'email=admin%40example.com&password=5f4dcc3b5aa765d61d8327deb882cf99&remember=true'),
+        ('json', 'application/json', '{"title": "Hello", "summary": "Summary", "content": "%s"}' % ('x' * 2000)),
+        ('multipart 64k', ) + _multipart(64 * 1024),
+        ('multipart 1m', ) + _multipart(1024 * 1024),
+    ]
+    number = 2000
+    print '%-16s %16s %16s' % ('body', 'FieldStorage (us)', 'parser (us)')
+    for name, content_type, body in cases:
+        n = number if len(body) < 100000 else number // 20
+        t2 = timeit.timeit(lambda: Request(_environ(content_type, body)).input(), number=n)
+        if content_type == 'application/json':
+            # FieldStorage cannot parse json bodies at all
+            print '%-16s %16s %16.2f' % (name, 'n/a', t2 * 1e6 / n)
+            continue
+        t1 = timeit.timeit(lambda: _field_storage_input(_environ(content_type, body)), number=n)
+        print '%-16s %16.2f %16.2f' % (name, t1 * 1e6 / n, t2 * 1e6 / n)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+microbenchmark: segment tree Router vs linear regex scan with 500 routes
+'''
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'www'))
+
+from transwarp.web import Route, Router, get
+
+ROUTES = 500
+
+def _handler(*args):
+    return args
+
+def _make_routes():
+    L = []
+    for n in range(ROUTES):
+        if n % 2:
+            path = '/api/res%d/:item_id' % n
+        else:
+            path = '/res%d/list' % n
+        L.append(Route(get(path)(_handler)))
+    return L
+
+class _LinearDispatcher(object):
+    '''
+    dispatcher as WSGIApplication used to do: static dict, then every regex
+    '''
+    def __init__(self, routes):
+        self._static = dict([ (r.path, r) for r in routes if r.is_static ])
+        self._dynamic = [ r for r in routes if not r.is_static ]
+    
+    def match(self, method, path):
+        r = self._static.get(path)
+        if r:
+            return r, []
+        for r in self._dynamic:
+            args = r.match(path)
+            if args:
+                return r, args
+        return None
+
+def main():
+    routes = _make_routes()
+    linear = _LinearDispatcher(routes)
+    router = Router()
+    for r in routes:
+        router.add(r)
+    paths = {
+        'static': '/res250/list',
+        'dynamic (first)': '/api/res1/0012',
+        'dynamic (last)': '/api/res%d/0012' % (ROUTES - 1),
+        'not found': '/api/unknown/0012',
+    }
+    number = 20000
+    print '%-18s %14s %14s' % ('path', 'linear (us)', 'router (us)')
+    for name, path in sorted(paths.iteritems()):
+        assert (linear.match('GET', path) is None) == (router.match('GET', path) is None)
+        t1 = timeit.timeit(lambda: linear.match('GET', path), number=number)
+        t2 = timeit.timeit(lambda: router.match('GET', path), number=number)
+        print '%-18s %14.2f %14.2f' % (name, t1 * 1e6 / number, t2 * 1e6 / number)
+
+if __name__ == '__main__':
+    main()
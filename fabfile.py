@@ -44,10 +44,15 @@ def build():
     '''
     build dist package
     '''
-    includes = ['static', 'templates', 'transwarp', 'favicon.ico', '*.py']
+    includes = ['static', 'templates', 'templates_compiled', 'transwarp', 'favicon.ico', '*.py']
     excludes = ['test', '.*', '*.pyc', '*.pyo']
     local('rm -f dist/%s' % _TAR_FILE)
     with lcd(os.path.join(_current_path(), 'www')):
+        # precompile templates so cold workers skip lexing and compiling
+        local('rm -rf templates_compiled')
+        local('python wsgiapp.py compile')
+        # precompressed siblings served by StaticFileRoute
+        local('find static -type f \\( -name "*.css" -o -name "*.js" -o -name "*.svg" \\) -exec gzip -9 -k -f {} \\;')
         cmd = ['tar', '--dereference', '-czvf', '../dist/%s' % _TAR_FILE]
         cmd.extend(['--exclude=\'%s\'' % ex for ex in excludes])
         cmd.extend(includes)
@@ -29,7 +29,8 @@ create table blogs (
     `user_image` varchar(500) not null,
     `title` varchar(50) not null,
     `summary` varchar(200) not null,
-    `content` mediumtext not null,
+    `content` mediumblob not null,
+    `version` bigint not null default 0,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
     primary key (`id`)
@@ -41,7 +42,7 @@ create table comments (
     `user_id` varchar(50) not null,
     `user_name` varchar(50) not null,
     `user_image` varchar(500) not null,
-    `content` mediumtext not null,
+    `content` mediumblob not null,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
     primary key (`id`)
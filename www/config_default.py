@@ -10,6 +10,51 @@ configs = {
         'database': 'awesome'
     },
     'session': {
-        'secret': 'AwEsOmE'
+        'secret': 'AwEsOmE',
+        'key_version': 1,
+        'retired_secrets': (),
+        'max_age': 86400,
+        'revoke_ttl': 60
+    },
+    'web': {
+        'query_sample_rate': 0.01,
+        'query_repeat_limit': 10,
+        'max_body_size': 1024 * 1024,
+        'session_cookie': 'awesession',
+        'compress_level': 6,
+        'compress_min_size': 1024,
+        'serve_static': False,
+        'static_max_age': 3600,
+        'static_accel_prefix': None,
+        'metrics': True,
+        'metrics_path': '/metrics',
+        'metrics_dir': '/tmp/awesome-metrics',
+        'profile_dir': '/tmp/awesome-profiles',
+        'profile_keep': 50,
+        # limits and queue are per worker process, each waiter holds a thread,
+        # so keep limit + queue size at or below server threads or the limit
+        # is never reached and requests queue in the listen backlog instead
+        'admission_limits': {'page': 6, 'api': 4, 'manage': 2},
+        'admission_queue_size': 2,
+        'admission_timeout': 0.5,
+        'admission_retry_after': 1,
+        'response_cache_file': '/tmp/awesome-response-cache',
+        'ratelimit_file': '/tmp/awesome-ratelimit',
+        'trusted_proxies': ('127.0.0.1',),
+        'task_pool_size': 4,
+        'task_queue_size': 1000,
+        'task_retries': 2
+    },
+    'server': {
+        'host': '127.0.0.1',
+        'port': 9000,
+        'workers': 0,
+        'threads': 8,
+        'unix_socket': None,
+        'reuse_port': False,
+        'keepalive': 5
+    },
+    'template': {
+        'cache_dir': '/tmp/awesome-templates'
     }
 }
@@ -8,7 +8,7 @@ module for app data models
 import time
 
 from transwarp.db import generate_id
-from transwarp.orm import Model, StringField, BooleanField, FloatField, TextField
+from transwarp.orm import Model, StringField, BooleanField, FloatField, CompressedTextField, VersionField
 
 
 class User(Model):
@@ -16,7 +16,7 @@ class User(Model):
     
     id = StringField(primary_key=True, default=generate_id, ddl='varchar(50)')
     email = StringField(updatable=False, ddl='varchar(50)')
-    password = StringField(ddl='varchar(50)')
+    password = StringField(sensitive=True, ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image= StringField(ddl='varchar(500)')
@@ -31,7 +31,8 @@ class Blog(Model):
     user_image= StringField(ddl='varchar(500)')
     title = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
+    content = CompressedTextField()
+    version = VersionField()
     created_at = FloatField(updatable=False, default=time.time)
 
 class Comment(Model):
@@ -42,7 +43,7 @@ class Comment(Model):
     user_id = StringField(updatable=False, ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image= StringField(ddl='varchar(500)')
-    content = TextField()
+    content = CompressedTextField()
     created_at = FloatField(updatable=False, default=time.time)
 
 if __name__ == '__main__':
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+admission control: concurrency of each route class is capped by a limit
+adapted to observed latency, requests over the limit wait in a bounded
+priority queue and are rejected when it is full or the wait times out
+'''
+
+import heapq
+import itertools
+import math
+import threading
+
+class _Waiter(object):
+
+    __slots__ = ('priority', 'seq', 'event', 'granted', 'cancelled')
+    
+    def __init__(self, priority, seq):
+        self.priority = priority
+        self.seq = seq
+        self.event = threading.Event()
+        self.granted = False
+        self.cancelled = False
+    
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class Limiter(object):
+    '''
+    concurrency limit with a priority wait queue, the limit moves between
+    min_limit and max_limit by the gradient of long-term to short-term
+    latency, like the gradient limiters of Netflix concurrency-limits
+    
+    >>> l = Limiter(2, queue_size=1, timeout=0.01, adaptive=False)
+    >>> l.acquire(), l.acquire()
+    (True, True)
+    >>> l.acquire()
+    False
+    >>> l.in_flight
+    2
+    >>> l.release(0.01)
+    >>> l.acquire(high=True)
+    True
+    '''
+    def __init__(self, max_limit, min_limit=1, queue_size=None, timeout=0.5, adaptive=True, tolerance=2.0, smoothing=0.2):
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.limit = float(max_limit)
+        self.queue_size = max_limit if queue_size is None else queue_size
+        self.timeout = timeout
+        self.adaptive = adaptive
+        self.in_flight = 0
+        self._tolerance = tolerance
+        self._smoothing = smoothing
+        self._short_rtt = None
+        self._long_rtt = None
+        self._waiters = []
+        self._queued = 0
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+    
+    def acquire(self, high=False):
+        '''
+        take a slot, wait in queue if none is free, high priority requests
+        are woken first and may displace a queued normal one
+        '''
+        with self._lock:
+            if self.in_flight < int(self.limit) and not self._queued:
+                self.in_flight = self.in_flight + 1
+                return True
+            if self._queued >= self.queue_size:
+                if not high or not self._displace():
+                    return False
+            waiter = _Waiter(0 if high else 1, next(self._seq))
+            heapq.heappush(self._waiters, waiter)
+            self._queued = self._queued + 1
+        waiter.event.wait(self.timeout)
+        with self._lock:
+            if waiter.granted:
+                return True
+            if not waiter.cancelled:
+                waiter.cancelled = True
+                self._queued = self._queued - 1
+            return False
+    
+    def _displace(self):
+        # reject the latest normal waiter to make room
+        victim = None
+        for w in self._waiters:
+            if w.priority and not w.cancelled and (victim is None or w.seq > victim.seq):
+                victim = w
+        if victim is None:
+            return False
+        victim.cancelled = True
+        self._queued = self._queued - 1
+        victim.event.set()
+        return True
+    
+    def release(self, rtt=None):
+        '''
+        free slot of request that took rtt seconds and admit waiters
+        '''
+        with self._lock:
+            self.in_flight = self.in_flight - 1
+            if rtt is not None and self.adaptive:
+                self._update(rtt)
+            while self._waiters and self.in_flight < int(self.limit):
+                waiter = heapq.heappop(self._waiters)
+                if waiter.cancelled:
+                    continue
+                waiter.granted = True
+                self._queued = self._queued - 1
+                self.in_flight = self.in_flight + 1
+                waiter.event.set()
+    
+    def _update(self, rtt):
+        '''
+        >>> l = Limiter(100, min_limit=4)
+        >>> for i in range(50):
+        ...     l._update(0.01)
+        >>> int(l.limit)
+        100
+        >>> for i in range(50):
+        ...     l._update(0.2)
+        >>> int(l.limit) < 20
+        True
+        '''
+        if self._short_rtt is None:
+            self._short_rtt = self._long_rtt = rtt
+        self._short_rtt = self._short_rtt * 0.9 + rtt * 0.1
+        self._long_rtt = self._long_rtt * 0.99 + rtt * 0.01
+        if self._long_rtt > self._short_rtt * 2:
+            # latency recovered, let long-term baseline follow it down
+            self._long_rtt = self._long_rtt * 0.95
+        gradient = max(0.5, min(1.0, self._tolerance * self._long_rtt / self._short_rtt))
+        limit = self.limit * gradient + math.sqrt(self.limit)
+        limit = self.limit * (1 - self._smoothing) + limit * self._smoothing
+        self.limit = max(self.min_limit, min(self.max_limit, limit))
+
+class AdmissionController(object):
+    '''
+    limiter per route class, classes are chosen by path prefix
+    
+    >>> c = AdmissionController({'page': 10, 'api': 5}, classes=(('/api/', 'api'), ('/manage/', 'manage')))
+    >>> c.classify('/api/blog/1'), c.classify('/manage/'), c.classify('/blog/1')
+    ('api', 'manage', 'page')
+    >>> c.limiter('/api/blog/1').max_limit
+    5
+    >>> c.limiter('/manage/') is None
+    True
+    >>> sorted(c.limits.items())
+    [('api', 5), ('page', 10)]
+    '''
+    def __init__(self, limits, classes=(('/manage/', 'manage'), ('/api/', 'api')), default='page', **kw):
+        self._classes = tuple(classes)
+        self._default = default
+        self._limiters = dict([ (name, Limiter(limit, **kw)) for name, limit in limits.iteritems() if limit ])
+    
+    @property
+    def limits(self):
+        '''
+        max limit of each limited route class
+        '''
+        return dict([ (name, l.max_limit) for name, l in self._limiters.iteritems() ])
+    
+    def classify(self, path):
+        for prefix, name in self._classes:
+            if path.startswith(prefix):
+                return name
+        return self._default
+    
+    def limiter(self, path):
+        '''
+        limiter of route class of path, None if the class is not limited
+        '''
+        return self._limiters.get(self.classify(path))
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
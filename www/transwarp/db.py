@@ -7,11 +7,11 @@ module for database operation
 
 import functools
 import logging
-import threading
+import re
 import time
 import uuid
 
-from tool import SimpleDict
+from tool import SimpleDict, ContextLocal
 
 def generate_id(t=None):
     '''
@@ -27,6 +27,9 @@ class DBError(Exception):
 class MultiColumnsError(DBError):
     pass
 
+class QueryBudgetError(DBError):
+    pass
+
 # define database engine
 
 _engine = None
@@ -81,13 +84,15 @@ class _LasyConnection(object):
             logging.info('[DB] [close connection <%s>...]' % hex(id(_connection)))
             _connection.close()
             
-class _DatabaseContext(threading.local):
+class _DatabaseContext(object):
     '''
-    threading.local object, hold connection info
+    hold connection info of current thread or greenlet
     '''
     def __init__(self):
         self.connection = None
         self.transactions = 0
+        self.tracker = None
+        self.pending = []
     
     def is_init(self):
         return not self.connection is None
@@ -96,6 +101,7 @@ class _DatabaseContext(threading.local):
         logging.info('[DB] [open lasy connection...]')
         self.connection = _LasyConnection()
         self.transactions = 0
+        self.pending = []
     
     def cursor(self):
         return self.connection.cursor()
@@ -104,7 +110,7 @@ class _DatabaseContext(threading.local):
         self.connection.cleanup()
         self.connection = None
 
-_dbctx =_DatabaseContext()
+_dbctx = ContextLocal(_DatabaseContext)
 
 # define connection context
 
@@ -172,13 +178,16 @@ class _TransactionContext(object):
             logging.info('[DB] [Transaction] [commit ok.]')
         except:
             logging.warning('[DB] [Transaction] [commit failed, try rollback...]')
+            _dbctx.pending = []
             _dbctx.connection.rollback()
             logging.warning('[DB] [Transaction] [rollback ok.]')
             raise
+        _run_pending()
     
     def rollback(self):
         global _dbctx
         logging.warning('[DB] [Transaction] [rollback...]')
+        _dbctx.pending = []
         _dbctx.connection.rollback()
         logging.info('[DB] [Transaction] [rollback ok]')
     
@@ -195,6 +204,31 @@ class _TransactionContext(object):
             if self.should_close_conn:
                 _dbctx.cleanup()
 
+def _run_pending():
+    global _dbctx
+    L = _dbctx.pending
+    _dbctx.pending = []
+    for fn, args in L:
+        try:
+            fn(*args)
+        except Exception:
+            logging.exception('[DB] [after commit] [%s failed]' % getattr(fn, '__name__', fn))
+
+def on_commit(fn, *args):
+    '''
+    call fn(*args) after current transaction committed, discard it if rolled
+    back, call it at once when not in transaction (statement is autocommitted)
+    
+    >>> def notify(msg):
+    ...     print msg
+    >>> on_commit(notify, 'no transaction')
+    no transaction
+    '''
+    global _dbctx
+    _dbctx.pending.append((fn, args))
+    if _dbctx.transactions == 0:
+        _run_pending()
+
 def transaction():
     '''
     get _TransactionContext object, use by 'with' statement
@@ -233,10 +267,117 @@ def with_transaction(func):
             logging.warning('[DB] [Transaction] [%s]' % _ut)
     return _wrapper
 
+# define query tracking
+
+_RE_SQL_STRING = re.compile(r"'(?:[^'\\]|\\.)*'")
+_RE_SQL_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_RE_SQL_IN_LIST = re.compile(r'\bin\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+_RE_SQL_SPACE = re.compile(r'\s+')
+
+def _fingerprint(sql):
+    r'''
+    normalize SQL statement to its shape, literals and 'in' lists collapsed
+    
+    >>> _fingerprint('select * from user where id=%s')
+    'select * from user where id=?'
+    >>> _fingerprint("SELECT *  FROM user\n WHERE id=10 and name='Bob'")
+    'select * from user where id=? and name=?'
+    >>> _fingerprint('delete from user where id in (%s, %s, %s)')
+    'delete from user where id in (...)'
+    '''
+    s = sql.replace('%s', '?')
+    s = _RE_SQL_STRING.sub('?', s)
+    s = _RE_SQL_NUMBER.sub('?', s)
+    s = _RE_SQL_IN_LIST.sub('in (...)', s)
+    return _RE_SQL_SPACE.sub(' ', s).strip().lower()
+
+class _QueryTracker(object):
+    '''
+    count statements and statement shapes issued by current thread
+    
+    >>> t = _QueryTracker(2)
+    >>> for i in range(3):
+    ...     t.record('select * from user where id=%s')
+    >>> t.count
+    3
+    >>> t.shapes
+    {'select * from user where id=?': 3}
+    >>> t = _QueryTracker(2, strict=True)
+    >>> for i in range(3):
+    ...     t.record('select * from user where id=%s')
+    Traceback (most recent call last):
+      ...
+    QueryBudgetError: Statement repeated 3 times: select * from user where id=?
+    '''
+    def __init__(self, repeat_limit=10, strict=False):
+        self.repeat_limit = repeat_limit
+        self.strict = strict
+        self.count = 0
+        self.shapes = {}
+    
+    def record(self, sql):
+        self.count = self.count + 1
+        shape = _fingerprint(sql)
+        n = self.shapes.get(shape, 0) + 1
+        self.shapes[shape] = n
+        if n == self.repeat_limit + 1:
+            # report each shape only once per tracking scope
+            if self.strict:
+                raise QueryBudgetError('Statement repeated %d times: %s' % (n, shape))
+            logging.warning('[DB] [N+1] [statement repeated %d times: %s]' % (n, shape))
+
+class _TrackingContext(object):
+    '''
+    start and stop query tracking context
+    '''
+    def __init__(self, repeat_limit, strict):
+        self.repeat_limit = repeat_limit
+        self.strict = strict
+    
+    def __enter__(self):
+        global _dbctx
+        self.should_stop = _dbctx.tracker is None
+        if self.should_stop:
+            _dbctx.tracker = _QueryTracker(self.repeat_limit, self.strict)
+        return _dbctx.tracker
+    
+    def __exit__(self, exctype, excvalue, traceback):
+        global _dbctx
+        if self.should_stop:
+            _dbctx.tracker = None
+
+def tracking(repeat_limit=10, strict=False):
+    '''
+    get _TrackingContext object, used by 'with' statement, warn (or raise
+    QueryBudgetError if strict) when one statement shape repeats more than
+    repeat_limit times
+    
+    with tracking() as tracker:
+        pass
+    print tracker.count
+    '''
+    return _TrackingContext(repeat_limit, strict)
+
+def current_tracker():
+    '''
+    get tracker of current thread, None if not tracking
+    '''
+    return _dbctx.tracker
+
 # define SQL operation
 
+_observers = []
+
+def add_observer(fn):
+    '''
+    call fn(sql, seconds) after every statement, e.g. to export query time
+    '''
+    _observers.append(fn)
+
 def _profiling(st, sql='', *args):
     ut = time.time() - st
+    for fn in _observers:
+        fn(sql, ut)
     if ut > 0.1:
         logging.warning('[DB] [%s] [SQL] [%s] [%s]' % (ut, sql, args))
     else:
@@ -252,6 +393,8 @@ def _select(sql, first, *args):
         _st = time.time()
         cursor = _dbctx.connection.cursor()
         cursor.execute(sql, args)
+        if _dbctx.tracker:
+            _dbctx.tracker.record(sql)
         if cursor.description:
             names = [ x[0] for x in cursor.description ]
         if first:
@@ -341,6 +484,42 @@ def select(sql, *args):
     '''
     return _select(sql, False, *args)
 
+def iter_select(sql, *args, **kw):
+    '''
+    execute select SQL and yield rows from an unbuffered cursor on a dedicated
+    connection, rows are fetched in batches so large tables are never held in
+    memory, the query is issued on first iteration
+    
+    for row in iter_select('select * from user order by id'):
+        print row.name
+    '''
+    global _dbctx
+    batch_size = kw.get('batch_size', 500)
+    sql = sql.replace('?', '%s')
+    if _dbctx.tracker:
+        _dbctx.tracker.record(sql)
+    _st = time.time()
+    _connection = _engine.connect()
+    logging.info('[DB] [open streaming connection <%s>...]' % hex(id(_connection)))
+    try:
+        cursor = _connection.cursor(buffered=False)
+        cursor.execute(sql, args)
+        _profiling(_st, sql, *args)
+        names = [ x[0] for x in cursor.description ]
+        while True:
+            values = cursor.fetchmany(batch_size)
+            if not values:
+                break
+            for x in values:
+                yield SimpleDict(names, x)
+    finally:
+        logging.info('[DB] [close streaming connection <%s>...]' % hex(id(_connection)))
+        try:
+            _connection.close()
+        except Exception, e:
+            # unread rows left if consumer stopped early
+            logging.warning('[DB] [close streaming connection failed: %s]' % e)
+
 @with_connection
 def _update(sql, *args):
     global _dbctx
@@ -352,6 +531,8 @@ def _update(sql, *args):
         _st = time.time()
         cursor = _dbctx.connection.cursor()
         cursor.execute(sql, args)
+        if _dbctx.tracker:
+            _dbctx.tracker.record(sql)
         rtnVal = cursor.rowcount
         if _dbctx.transactions == 0:
             # no transaction environment
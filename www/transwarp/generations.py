@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+generation counters of cache tags, invalidating a tag bumps its counter and
+cached entries remember counters of their tags when rendered, counters are
+kept in a process dict or in an mmap file shared by pre-forked workers
+'''
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+class MemoryGenerations(object):
+    '''
+    tag counters of current process
+    
+    >>> g = MemoryGenerations()
+    >>> g.snapshot(['blogs', 'blog:1'])
+    (0, 0)
+    >>> g.bump('blog:1')
+    >>> g.snapshot(['blogs', 'blog:1'])
+    (0, 1)
+    '''
+    def __init__(self):
+        self._counters = {}
+        self._lock = threading.Lock()
+    
+    def snapshot(self, tags):
+        return tuple([ self._counters.get(tag, 0) for tag in tags ])
+    
+    def bump(self, *tags):
+        with self._lock:
+            for tag in tags:
+                self._counters[tag] = self._counters.get(tag, 0) + 1
+
+class SharedGenerations(object):
+    '''
+    tag counters in an mmap file shared by processes, tags are hashed to
+    slots and tags sharing a slot only invalidate each other more often
+    
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'generations')
+    >>> g1 = SharedGenerations(path, slots=64)
+    >>> g2 = SharedGenerations(path, slots=64)
+    >>> before = g2.snapshot(['blog:1'])
+    >>> g1.bump('blog:1')
+    >>> g2.snapshot(['blog:1']) == before
+    False
+    '''
+    _SLOT = struct.Struct('Q')
+    
+    def __init__(self, path, slots=4096):
+        self._slots = slots
+        self._lock = threading.Lock()
+        size = slots * SharedGenerations._SLOT.size
+        self._file = open(path, 'a+b')
+        if os.fstat(self._file.fileno()).st_size != size:
+            self._file.truncate(size)
+        self._mm = mmap.mmap(self._file.fileno(), size)
+    
+    def _offset(self, tag):
+        if isinstance(tag, unicode):
+            tag = tag.encode('utf-8')
+        h = struct.unpack('Q', hashlib.md5(tag).digest()[:8])[0]
+        return (h % self._slots) * SharedGenerations._SLOT.size
+    
+    def snapshot(self, tags):
+        slot = SharedGenerations._SLOT
+        return tuple([ slot.unpack_from(self._mm, self._offset(tag))[0] for tag in tags ])
+    
+    def bump(self, *tags):
+        slot = SharedGenerations._SLOT
+        with self._lock:
+            # record lock excludes other processes, threads hold self._lock
+            fcntl.lockf(self._file, fcntl.LOCK_EX)
+            try:
+                for tag in tags:
+                    offset = self._offset(tag)
+                    slot.pack_into(self._mm, offset, slot.unpack_from(self._mm, offset)[0] + 1)
+            finally:
+                fcntl.lockf(self._file, fcntl.LOCK_UN)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
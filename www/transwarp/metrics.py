@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+metrics registry of counters, gauges and histograms in the Prometheus text
+format, values are kept in process memory, or in one mmap file per process
+when workers are pre-forked, and files of all workers are summed on expose
+'''
+
+import bisect
+import collections
+import errno
+import json
+import mmap
+import os
+import struct
+import threading
+
+_INF = float('inf')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, _INF)
+
+def _format_value(v):
+    '''
+    format sample value or bucket bound
+    
+    >>> _format_value(3.0)
+    '3.0'
+    >>> _format_value(_INF)
+    '+Inf'
+    '''
+    if v == _INF:
+        return '+Inf'
+    return repr(float(v))
+
+def _escape(s):
+    return s.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+class _MemoryStore(object):
+    '''
+    values of current process
+    '''
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def add(self, key, amount):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+    
+    def set(self, key, value):
+        with self._lock:
+            self._values[key] = value
+    
+    def read(self):
+        '''
+        list of (process alive, values)
+        '''
+        with self._lock:
+            return [(True, dict(self._values))]
+
+class _FileStore(object):
+    '''
+    values in an mmap file per process, entry layout is key length (int),
+    utf-8 key padded to 8 bytes, value (double), used size is kept in the
+    first 8 bytes and written last so readers never see partial entries
+    
+    >>> import tempfile
+    >>> store = _FileStore(tempfile.mkdtemp())
+    >>> store.add('a', 1.0)
+    >>> store.add('a', 2.0)
+    >>> store.set('b', 5.0)
+    >>> store.read()
+    [(True, {u'a': 3.0, u'b': 5.0})]
+    '''
+    _INITIAL_SIZE = 16384
+    
+    def __init__(self, directory):
+        self._directory = directory
+        self._lock = threading.Lock()
+        self._pid = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # files of processes from previous runs
+        for name, pid in self._files():
+            if not _pid_alive(pid):
+                os.remove(os.path.join(directory, name))
+    
+    def _files(self):
+        for name in os.listdir(self._directory):
+            if name.endswith('.db') and name[:-3].isdigit():
+                yield name, int(name[:-3])
+    
+    def _open(self):
+        # forked worker writes its own file
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        self._file = open(os.path.join(self._directory, '%d.db' % pid), 'w+b')
+        self._file.truncate(_FileStore._INITIAL_SIZE)
+        self._mm = mmap.mmap(self._file.fileno(), _FileStore._INITIAL_SIZE)
+        self._used = 8
+        struct.pack_into('i', self._mm, 0, self._used)
+        self._offsets = {}
+        self._pid = pid
+    
+    def _offset(self, key):
+        offset = self._offsets.get(key)
+        if offset is not None:
+            return offset
+        data = key.encode('utf-8')
+        size = 4 + len(data)
+        size = size + (8 - size % 8) % 8
+        used = self._used + size + 8
+        if used > len(self._mm):
+            capacity = len(self._mm)
+            while capacity < used:
+                capacity = capacity * 2
+            self._mm.close()
+            self._file.truncate(capacity)
+            self._mm = mmap.mmap(self._file.fileno(), capacity)
+        struct.pack_into('i%ds' % len(data), self._mm, self._used, len(data), data)
+        offset = self._used + size
+        struct.pack_into('d', self._mm, offset, 0.0)
+        self._used = used
+        struct.pack_into('i', self._mm, 0, used)
+        self._offsets[key] = offset
+        return offset
+    
+    def add(self, key, amount):
+        with self._lock:
+            self._open()
+            offset = self._offset(key)
+            struct.pack_into('d', self._mm, offset, struct.unpack_from('d', self._mm, offset)[0] + amount)
+    
+    def set(self, key, value):
+        with self._lock:
+            self._open()
+            struct.pack_into('d', self._mm, self._offset(key), value)
+    
+    def read(self):
+        L = []
+        for name, pid in self._files():
+            try:
+                with open(os.path.join(self._directory, name), 'rb') as f:
+                    data = f.read()
+            except IOError:
+                continue
+            values = {}
+            used = struct.unpack_from('i', data, 0)[0] if len(data) >= 8 else 0
+            pos = 8
+            while pos < used:
+                n = struct.unpack_from('i', data, pos)[0]
+                key = data[pos + 4:pos + 4 + n].decode('utf-8')
+                size = 4 + n
+                size = size + (8 - size % 8) % 8
+                values[key] = struct.unpack_from('d', data, pos + size)[0]
+                pos = pos + size + 8
+            L.append((_pid_alive(pid), values))
+        return L
+
+def _key(name, suffix, labels):
+    return json.dumps([name, suffix, labels])
+
+class _Child(object):
+    '''
+    metric with label values bound, keys are computed once
+    '''
+    def __init__(self, metric, labels):
+        self._store = metric._registry
+        self._labels = labels
+        self._key = _key(metric.name, '', labels)
+        if isinstance(metric, Histogram):
+            self._buckets = metric.buckets
+            self._bucket_keys = [ _key(metric.name, '_bucket', labels + [['le', _format_value(b)]]) for b in metric.buckets ]
+            self._sum_key = _key(metric.name, '_sum', labels)
+            self._count_key = _key(metric.name, '_count', labels)
+    
+    def inc(self, amount=1):
+        self._store.store.add(self._key, amount)
+    
+    def dec(self, amount=1):
+        self._store.store.add(self._key, -amount)
+    
+    def set(self, value):
+        self._store.store.set(self._key, value)
+    
+    def observe(self, value):
+        store = self._store.store
+        store.add(self._bucket_keys[bisect.bisect_left(self._buckets, value)], 1)
+        store.add(self._sum_key, value)
+        store.add(self._count_key, 1)
+
+class _Metric(object):
+
+    kind = None
+    
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self._registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+    
+    def labels(self, *values):
+        '''
+        get metric bound to label values in order of labelnames
+        '''
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('Expect labels: %s' % ', '.join(self.labelnames))
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    labels = [ [n, unicode(v)] for n, v in zip(self.labelnames, values) ]
+                    child = self._children[values] = _Child(self, labels)
+        return child
+    
+    def samples(self, values):
+        '''
+        list of (name, labels, value) from aggregated values
+        '''
+        L = []
+        for key, value in values.iteritems():
+            name, suffix, labels = json.loads(key)
+            if name == self.name:
+                L.append((name + suffix, labels, value))
+        L.sort()
+        return L
+
+class Counter(_Metric):
+    '''
+    value only goes up, summed over processes
+    
+    >>> r = Registry()
+    >>> c = r.counter('jobs_total', 'Jobs done.', ['kind'])
+    >>> c.labels('mail').inc()
+    >>> c.labels('mail').inc(2)
+    >>> print r.expose(),
+    # HELP jobs_total Jobs done.
+    # TYPE jobs_total counter
+    jobs_total{kind="mail"} 3.0
+    '''
+    kind = 'counter'
+    
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+class Gauge(_Metric):
+    '''
+    value goes up and down, summed over live processes
+    
+    >>> r = Registry()
+    >>> g = r.gauge('in_flight', 'In flight.')
+    >>> g.inc()
+    >>> g.inc()
+    >>> g.dec()
+    >>> print r.expose(),
+    # HELP in_flight In flight.
+    # TYPE in_flight gauge
+    in_flight 1.0
+    '''
+    kind = 'gauge'
+    
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+    
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+    
+    def set(self, value):
+        self.labels().set(value)
+
+class Histogram(_Metric):
+    '''
+    observations counted in buckets, exposed as cumulative buckets, sum and
+    count
+    
+    >>> r = Registry()
+    >>> h = r.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1.0))
+    >>> for v in (0.05, 0.5, 5):
+    ...     h.observe(v)
+    >>> print r.expose(),
+    # HELP latency_seconds Latency.
+    # TYPE latency_seconds histogram
+    latency_seconds_bucket{le="0.1"} 1.0
+    latency_seconds_bucket{le="1.0"} 2.0
+    latency_seconds_bucket{le="+Inf"} 3.0
+    latency_seconds_count 3.0
+    latency_seconds_sum 5.55
+    '''
+    kind = 'histogram'
+    
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(registry, name, documentation, labelnames)
+        buckets = [ float(b) for b in buckets ]
+        if buckets[-1] != _INF:
+            buckets.append(_INF)
+        self.buckets = buckets
+    
+    def observe(self, value):
+        self.labels().observe(value)
+    
+    def samples(self, values):
+        L = super(Histogram, self).samples(values)
+        buckets = {}
+        others = []
+        for name, labels, value in L:
+            if name.endswith('_bucket'):
+                le = labels[-1][1]
+                buckets.setdefault(tuple(map(tuple, labels[:-1])), {})[le] = value
+            else:
+                others.append((name, labels, value))
+        result = []
+        for labels, counts in sorted(buckets.iteritems()):
+            total = 0.0
+            for b in self.buckets:
+                total = total + counts.get(_format_value(b), 0.0)
+                result.append((self.name + '_bucket', map(list, labels) + [['le', _format_value(b)]], total))
+        return result + others
+
+class Registry(object):
+    '''
+    named metrics with their store, in memory unless a directory is given
+    '''
+    def __init__(self, directory=None):
+        self._metrics = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.configure(directory)
+    
+    def configure(self, directory=None):
+        '''
+        set store, call before forking workers which then share directory
+        '''
+        self.store = _FileStore(directory) if directory else _MemoryStore()
+    
+    def _register(self, cls, name, *args, **kw):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(self, name, *args, **kw)
+            elif not isinstance(metric, cls):
+                raise ValueError('Metric %s is already registered as %s.' % (name, metric.kind))
+            return metric
+    
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+    
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+    
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+    
+    def expose(self):
+        '''
+        all metrics in the Prometheus text format
+        '''
+        totals = {}
+        live = {}
+        for alive, values in self.store.read():
+            for key, value in values.iteritems():
+                totals[key] = totals.get(key, 0.0) + value
+                if alive:
+                    live[key] = live.get(key, 0.0) + value
+        L = []
+        for metric in self._metrics.itervalues():
+            # gauge of exited worker is meaningless, counters keep counting
+            values = live if metric.kind == 'gauge' else totals
+            L.append('# HELP %s %s' % (metric.name, _escape(metric.documentation)))
+            L.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples(values):
+                if labels:
+                    name = '%s{%s}' % (name, ','.join([ '%s="%s"' % (k, _escape(v)) for k, v in labels ]))
+                L.append('%s %s' % (name, _format_value(value)))
+        L.append('')
+        return '\n'.join(L).encode('utf-8')
+
+# default registry
+
+REGISTRY = Registry()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -6,8 +6,12 @@ module for object-relationship mapping
 '''
 
 import logging
+import Queue
+import threading
+import zlib
 
 import db
+from tool import SimpleDict
 
 class Field(object):
     
@@ -21,6 +25,8 @@ class Field(object):
         self.updatable = kw.get('updatable', True)
         self.nullable = kw.get('nullable', False)
         self.primary_key = kw.get('primary_key', False)
+        # never serialized by @api responses
+        self.sensitive = kw.get('sensitive', False)
         self._order = Field._count
         Field._count = Field._count + 1
     
@@ -91,12 +97,159 @@ class BlobField(Field):
             kw['default'] = ''
         super(BlobField, self).__init__(**kw)
 
+# compressed text is stored as mark + codec + payload, the mark never
+# starts a valid utf-8 string so plain and compressed values can share
+# one blob column
+
+_COMPRESSED_MARK = '\xff'
+
+def _import_zstd():
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        return None
+
+class _CompressedValue(object):
+    '''
+    compressed column value loaded from database, decompressed on first access
+    '''
+    __slots__ = ('data',)
+    
+    def __init__(self, data):
+        self.data = data
+    
+    def load(self):
+        codec, payload = self.data[1:2], self.data[2:]
+        if codec == 'z':
+            return zlib.decompress(payload).decode('utf-8')
+        if codec == 's':
+            zstd = _import_zstd()
+            if zstd is None:
+                raise StandardError('zstandard module is required to decompress value.')
+            return zstd.ZstdDecompressor().decompress(payload).decode('utf-8')
+        raise ValueError('Unknown compression codec: %r' % codec)
+
+class CompressedTextField(Field):
+    '''
+    text stored as zlib/zstd compressed bytes in a blob column, values shorter
+    than threshold (utf-8 bytes) or not worth compressing are stored plain
+    
+    >>> f = CompressedTextField(threshold=16)
+    >>> f.to_db(u'short')
+    'short'
+    >>> s = f.to_db(u'\u4e2d\u6587' * 100)
+    >>> s[:2], len(s) < 600
+    ('\\xffz', True)
+    >>> f.from_db(s).load() == u'\u4e2d\u6587' * 100
+    True
+    >>> f.from_db('short')
+    u'short'
+    '''
+    def __init__(self, **kw):
+        if not 'ddl' in kw:
+            kw['ddl'] = 'mediumblob'
+        if not 'default' in kw:
+            kw['default'] = ''
+        self.threshold = kw.get('threshold', 512)
+        self.codec = kw.get('codec', 'zlib')
+        self.level = kw.get('level', 6)
+        if self.codec == 'zstd' and _import_zstd() is None:
+            logging.warning('[ORM] [zstandard not installed, fall back to zlib]')
+            self.codec = 'zlib'
+        super(CompressedTextField, self).__init__(**kw)
+    
+    def to_db(self, value):
+        if isinstance(value, _CompressedValue):
+            return value.data
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        if value is None or len(value) < self.threshold:
+            return value
+        if self.codec == 'zstd':
+            data = 's' + _import_zstd().ZstdCompressor(level=self.level).compress(value)
+        else:
+            data = 'z' + zlib.compress(value, self.level)
+        if len(data) + 1 >= len(value):
+            return value
+        return _COMPRESSED_MARK + data
+    
+    def from_db(self, value):
+        if isinstance(value, bytearray):
+            value = str(value)
+        if isinstance(value, str):
+            if value[:1] == _COMPRESSED_MARK:
+                return _CompressedValue(value)
+            return value.decode('utf-8')
+        return value
+
 class VersionField(Field):
     
     def __init__(self, name=None):
         super(VersionField, self).__init__(name=name, ddl='bigint', default=0)
 
-_triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete'])
+class ConflictError(db.DBError):
+    pass
+
+_triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete', 'post_insert', 'post_update', 'post_delete'])
+
+# define change events
+
+_subscribers = []
+_events = None
+_events_lock = threading.Lock()
+
+def subscribe(fn, background=False):
+    '''
+    register fn(event) to receive change events after commit, event is a
+    SimpleDict(model, table, pk, operation, fields), background subscribers
+    are called from a queue consumer thread
+    '''
+    _subscribers.append((fn, background))
+
+def unsubscribe(fn):
+    _subscribers[:] = [ (f, b) for f, b in _subscribers if f is not fn ]
+
+def _consume_events(q):
+    while True:
+        fn, event = q.get()
+        try:
+            fn(event)
+        except Exception:
+            logging.exception('[ORM] [event subscriber %s failed]' % getattr(fn, '__name__', fn))
+
+def _event_queue():
+    global _events
+    if _events is None:
+        with _events_lock:
+            if _events is None:
+                q = Queue.Queue()
+                t = threading.Thread(target=_consume_events, args=(q,), name='orm-events')
+                t.daemon = True
+                t.start()
+                _events = q
+    return _events
+
+def _dispatch(event):
+    '''
+    deliver change event to subscribers
+    
+    >>> def printer(event):
+    ...     print event.model, event.pk, event.operation, event.fields
+    >>> subscribe(printer)
+    >>> _dispatch(SimpleDict(model='Blog', table='blogs', pk='001', operation='update', fields=['title']))
+    Blog 001 update ['title']
+    >>> unsubscribe(printer)
+    >>> _dispatch(SimpleDict(model='Blog', table='blogs', pk='001', operation='delete', fields=[]))
+    '''
+    for fn, background in list(_subscribers):
+        if background:
+            _event_queue().put((fn, event))
+            continue
+        try:
+            fn(event)
+        except Exception:
+            logging.exception('[ORM] [event subscriber %s failed]' % getattr(fn, '__name__', fn))
 
 def _generate_table(table_name, mappings):
     _pk = ''
@@ -115,6 +268,108 @@ def _generate_table(table_name, mappings):
     sql.append(');')
     return '\n'.join(sql)
 
+# define aggregation
+
+_AGGREGATES = ('count', 'sum', 'max')
+
+def _to_names(names):
+    if names is None or names is False:
+        return []
+    if isinstance(names, basestring):
+        return [names]
+    return list(names)
+
+def _aggregate_spec(group_by, kw):
+    '''
+    normalize aggregate arguments as ([group column], [(function, column, alias)])
+    
+    >>> _aggregate_spec('blog_id', dict(count=True))
+    (['blog_id'], [('count', None, 'count')])
+    >>> _aggregate_spec(None, dict(sum=['a', 'b'], max='c'))
+    ([], [('sum', 'a', 'sum_a'), ('sum', 'b', 'sum_b'), ('max', 'c', 'max_c')])
+    >>> _aggregate_spec(None, dict(sum=True))
+    Traceback (most recent call last):
+      ...
+    ValueError: Aggregate 'sum' needs column names.
+    >>> _aggregate_spec(None, dict(avg='a'))
+    Traceback (most recent call last):
+      ...
+    TypeError: Unsupported aggregate: avg
+    '''
+    for k in kw:
+        if not k in _AGGREGATES:
+            raise TypeError('Unsupported aggregate: %s' % k)
+    specs = []
+    for func in _AGGREGATES:
+        v = kw.get(func)
+        if v is True or v == '*':
+            if func != 'count':
+                raise ValueError("Aggregate '%s' needs column names." % func)
+            specs.append((func, None, func))
+            continue
+        for col in _to_names(v):
+            specs.append((func, col, '%s_%s' % (func, col)))
+    if not specs:
+        raise ValueError('Expect at least one aggregate.')
+    return _to_names(group_by), specs
+
+def aggregate_rows(rows, group_by=None, **kw):
+    '''
+    aggregate an already-loaded list of models (or dicts) in memory,
+    return rows in the same shape as Model.aggregate()
+    
+    >>> L = [dict(blog_id='a', n=1), dict(blog_id='b', n=5), dict(blog_id='a', n=3)]
+    >>> for r in aggregate_rows(L, group_by='blog_id', count=True, sum='n', max='n'):
+    ...     print r.blog_id, r.count, r.sum_n, r.max_n
+    a 2 4 3
+    b 1 5 5
+    >>> r = aggregate_rows([], count=True, sum='n')[0]
+    >>> r.count, r.sum_n
+    (0, None)
+    '''
+    groups, specs = _aggregate_spec(group_by, kw)
+    rows = list(rows)
+    # assign each row a group index once, then fold every aggregate column-wise
+    index = {}
+    keys = []
+    slots = []
+    for r in rows:
+        key = tuple([ r[g] for g in groups ])
+        i = index.get(key)
+        if i is None:
+            i = index[key] = len(keys)
+            keys.append(key)
+        slots.append(i)
+    if not groups and not keys:
+        keys.append(())
+    results = []
+    for func, col, alias in specs:
+        if func == 'count':
+            acc = [0] * len(keys)
+            if col is None:
+                for i in slots:
+                    acc[i] += 1
+            else:
+                for i, r in zip(slots, rows):
+                    if r[col] is not None:
+                        acc[i] += 1
+        else:
+            acc = [None] * len(keys)
+            for i, r in zip(slots, rows):
+                v = r[col]
+                if v is None:
+                    continue
+                a = acc[i]
+                if a is None:
+                    acc[i] = v
+                elif func == 'sum':
+                    acc[i] = a + v
+                elif v > a:
+                    acc[i] = v
+        results.append(acc)
+    names = groups + [ alias for func, col, alias in specs ]
+    return [ SimpleDict(names, list(key) + [ acc[n] for acc in results ]) for n, key in enumerate(keys) ]
+
 class ModelMetaclass(type):
     '''
     metaclass for Model object
@@ -135,6 +390,8 @@ class ModelMetaclass(type):
         logging.info('[ORM] [scan %s class...]' % name)
         mappings = dict()
         _pk = None
+        _version = None
+        _compressed = []
         for k, v in attrs.iteritems():
             if isinstance(v, Field):
                 if not v.name:
@@ -151,6 +408,13 @@ class ModelMetaclass(type):
                         logging.warning('[ORM] [NOTE: change primary key to non-nullable]') 
                         v.nullable = False
                     _pk = v
+                # check version field
+                if isinstance(v, VersionField):
+                    if _version:
+                        raise TypeError("Duplicate version fields in class '%s'." % name)
+                    _version = v
+                if isinstance(v, CompressedTextField):
+                    _compressed.append(k)
                 mappings[k] = v
                 logging.info('[ORM] [found mapping: %s => %s]' % (k, v))
         
@@ -164,6 +428,8 @@ class ModelMetaclass(type):
             attrs['__table__'] = name.lower()
         attrs['__mappings__'] = mappings
         attrs['__primary_key__'] = _pk
+        attrs['__version_field__'] = _version
+        attrs['__compressed__'] = _compressed
         attrs['__sql__'] = lambda self: _generate_table(attrs['__table__'], mappings)
         for trigger in _triggers:
             if not trigger in attrs:
@@ -223,6 +489,48 @@ class Model(dict):
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
     
+    def __getitem__(self, key):
+        v = dict.__getitem__(self, key)
+        if isinstance(v, _CompressedValue):
+            v = v.load()
+            dict.__setitem__(self, key, v)
+        return v
+    
+    def _load_compressed(self):
+        '''
+        decompress loaded values in place, so that dict access which does not
+        go through __getitem__ never sees a compressed value
+        
+        >>> class Post(Model):
+        ...     id = IntegerField(primary_key=True)
+        ...     content = CompressedTextField(threshold=16)
+        >>> p = Post._from_db(dict(id=1, content=Post.__mappings__['content'].to_db(u'abc' * 100)))
+        >>> u'abc' * 100 in p.values()
+        True
+        >>> dict.__getitem__(p, 'content') == u'abc' * 100
+        True
+        '''
+        for k in self.__compressed__:
+            v = dict.get(self, k)
+            if isinstance(v, _CompressedValue):
+                dict.__setitem__(self, k, v.load())
+    
+    def items(self):
+        self._load_compressed()
+        return dict.items(self)
+    
+    def iteritems(self):
+        self._load_compressed()
+        return dict.iteritems(self)
+    
+    def values(self):
+        self._load_compressed()
+        return dict.values(self)
+    
+    def itervalues(self):
+        self._load_compressed()
+        return dict.itervalues(self)
+    
     def __getattr__(self, key):
         try:
             return self[key]
@@ -231,6 +539,24 @@ class Model(dict):
     
     def __setattr__(self, key, value):
         self[key] = value
+        # remember assigned fields for change events
+        self.__dict__.setdefault('_assigned', set()).add(key)
+    
+    def _changed(self, operation, fields):
+        self.__dict__.pop('_assigned', None)
+        hook = getattr(self, 'post_%s' % operation)
+        if hook:
+            db.on_commit(hook)
+        if _subscribers:
+            event = SimpleDict(model=self.__class__.__name__, table=self.__table__, pk=self[self.__primary_key__.name], operation=operation, fields=fields)
+            db.on_commit(_dispatch, event)
+    
+    @classmethod
+    def _from_db(cls, d):
+        for k in cls.__compressed__:
+            if k in d:
+                d[k] = cls.__mappings__[k].from_db(d[k])
+        return cls(**d)
     
     @classmethod
     def get(cls, pk):
@@ -238,7 +564,7 @@ class Model(dict):
         'select' by pk, return one
         '''
         d = db.select_one('select * from `%s` where %s=?' % (cls.__table__, cls.__primary_key__.name), pk)
-        return cls(**d) if d else None
+        return cls._from_db(d) if d else None
     
     @classmethod
     def find_first(cls, where, *args):
@@ -246,7 +572,7 @@ class Model(dict):
         'select' with 'where', return one
         '''
         d = db.select_one('select * from %s %s' % (cls.__table__, where), *args)
-        return cls(**d) if d else None
+        return cls._from_db(d) if d else None
     
     @classmethod
     def find_all(cls, *args):
@@ -254,7 +580,7 @@ class Model(dict):
         'select', return all
         '''
         L = db.select('select * from `%s`' % cls.__table__)
-        return [ cls(**d) for d in L ]
+        return [ cls._from_db(d) for d in L ]
     
     @classmethod
     def find_by(cls, where, *args):
@@ -262,7 +588,15 @@ class Model(dict):
         'select' with 'where', return all
         '''
         L = db.select('select * from `%s` %s' % (cls.__table__, where), *args)
-        return [ cls(**d) for d in L ]
+        return [ cls._from_db(d) for d in L ]
+    
+    @classmethod
+    def iter_by(cls, where='', *args):
+        '''
+        'select' with 'where' from a streaming cursor, yield one by one
+        '''
+        for d in db.iter_select('select * from `%s` %s' % (cls.__table__, where), *args):
+            yield cls._from_db(d)
     
     @classmethod
     def count_all(cls):
@@ -278,6 +612,29 @@ class Model(dict):
         '''
         return db.select_int('select count(`%s`) from `%s` %s' % (cls.__primary_key__.name, cls.__table__, where), *args)
     
+    @classmethod
+    def aggregate(cls, where='', *args, **kw):
+        '''
+        'count/sum/max' with optional 'where' and 'group by', return rows
+        
+        Comment.aggregate(group_by='blog_id', count=True)
+        ==> [{'blog_id': u'...', 'count': 12}, ...]
+        Blog.aggregate('where created_at>?', t, group_by='user_id', count=True, max='created_at')
+        ==> [{'user_id': u'...', 'count': 3, 'max_created_at': 1402909113.628}, ...]
+        '''
+        groups, specs = _aggregate_spec(kw.pop('group_by', None), kw)
+        columns = set([ f.name for f in cls.__mappings__.itervalues() ])
+        for col in groups + [ col for func, col, alias in specs if col ]:
+            if not col in columns:
+                raise ValueError("'%s' is not a field of '%s'." % (col, cls.__name__))
+        L = [ '`%s`' % col for col in groups ]
+        for func, col, alias in specs:
+            L.append('%s(%s) as `%s`' % (func, '*' if col is None else '`%s`' % col, alias))
+        sql = 'select %s from `%s` %s' % (','.join(L), cls.__table__, where)
+        if groups:
+            sql = '%s group by %s' % (sql, ','.join([ '`%s`' % col for col in groups ]))
+        return db.select(sql, *args)
+    
     def insert(self):
         self.pre_insert and self.pre_insert()
         params = {}
@@ -285,17 +642,29 @@ class Model(dict):
             if v.insertable:
                 if not hasattr(self, k):
                     setattr(self, k, v.default)
-                params[v.name] = getattr(self, k)
+                if k in self.__compressed__:
+                    params[v.name] = v.to_db(dict.get(self, k))
+                else:
+                    params[v.name] = getattr(self, k)
         db.insert('%s' % self.__table__, **params)
+        self._changed('insert', params.keys())
         return self
     
     def update(self):
+        '''
+        'update' by pk, with a VersionField the row is only updated if its
+        version is unchanged since loaded, otherwise raise ConflictError
+        '''
         self.pre_update and self.pre_update()
         L = []
         args = []
+        vf = self.__version_field__
         for k, v in self.__mappings__.iteritems():
-            if v.updatable:
-                if hasattr(self, k):
+            if v.updatable and not v is vf:
+                if k in self.__compressed__ and k in self:
+                    # untouched compressed value is written back as loaded
+                    arg = v.to_db(dict.get(self, k))
+                elif hasattr(self, k):
                     arg = getattr(self, k)
                 else:
                     arg = v.default
@@ -303,8 +672,22 @@ class Model(dict):
                 L.append('`%s`=?' % k)
                 args.append(arg)
         pk = self.__primary_key__.name
+        assigned = self.__dict__.get('_assigned', ())
+        fields = [ v.name for k, v in self.__mappings__.iteritems() if v.updatable and k in assigned ]
+        if vf is None:
+            args.append(getattr(self, pk))
+            db.update('update `%s` set %s where %s=?' % (self.__table__, ','.join(L), pk), *args)
+            self._changed('update', fields)
+            return self
+        version = getattr(self, vf.name) if hasattr(self, vf.name) else vf.default
+        L.append('`%s`=?' % vf.name)
+        args.append(version + 1)
         args.append(getattr(self, pk))
-        db.update('update `%s` set %s where %s=?' % (self.__table__, ','.join(L), pk), *args)
+        args.append(version)
+        if db.update('update `%s` set %s where %s=? and `%s`=?' % (self.__table__, ','.join(L), pk, vf.name), *args) == 0:
+            raise ConflictError("'%s' <%s> was modified or deleted since version %s." % (self.__class__.__name__, getattr(self, pk), version))
+        setattr(self, vf.name, version + 1)
+        self._changed('update', fields)
         return self
     
     def delete(self):
@@ -312,8 +695,55 @@ class Model(dict):
         pk = self.__primary_key__.name
         args = (getattr(self, pk),)
         db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
+        self._changed('delete', [])
         return self
 
+def compress_rows(cls, batch_size=100):
+    '''
+    compress existing plain values of CompressedTextField columns in batches,
+    return count of updated rows. Alter the columns to blob type first:
+    
+    alter table `blogs` modify `content` mediumblob not null;
+    compress_rows(Blog)
+    '''
+    fields = [ cls.__mappings__[k] for k in cls.__compressed__ ]
+    if not fields:
+        raise ValueError("'%s' has no CompressedTextField." % cls.__name__)
+    pk = cls.__primary_key__.name
+    cols = ','.join([ '`%s`' % f.name for f in fields ])
+    total = 0
+    last = None
+    while True:
+        if last is None:
+            L = db.select('select `%s`,%s from `%s` order by `%s` limit ?' % (pk, cols, cls.__table__, pk), batch_size)
+        else:
+            L = db.select('select `%s`,%s from `%s` where `%s`>? order by `%s` limit ?' % (pk, cols, cls.__table__, pk, pk), last, batch_size)
+        if not L:
+            break
+        with db.transaction():
+            for r in L:
+                sets = []
+                args = []
+                for f in fields:
+                    raw = r[f.name]
+                    if isinstance(raw, bytearray):
+                        raw = str(raw)
+                    if isinstance(raw, unicode):
+                        raw = raw.encode('utf-8')
+                    if not raw or raw[:1] == _COMPRESSED_MARK:
+                        continue
+                    data = f.to_db(raw)
+                    if data[:1] == _COMPRESSED_MARK:
+                        sets.append('`%s`=?' % f.name)
+                        args.append(data)
+                if sets:
+                    args.append(r[pk])
+                    db.update('update `%s` set %s where `%s`=?' % (cls.__table__, ','.join(sets), pk), *args)
+                    total = total + 1
+        last = L[-1][pk]
+        logging.info('[ORM] [compressed %s rows of %s]' % (total, cls.__table__))
+    return total
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     db.create_engine('www-data', 'www-data', 'test')
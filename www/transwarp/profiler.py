@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+per-request profiling with cProfile, every capture is saved as a pstats file,
+a collapsed-stack file for flamegraph.pl / speedscope and a summary of the
+top functions
+'''
+
+import cProfile
+import json
+import logging
+import os
+import pstats
+import re
+import threading
+import time
+
+_RE_LABEL = re.compile(r'[^\w\-]+')
+
+def _func_name(func):
+    filename, line, name = func
+    if filename == '~':
+        # built-in function
+        return name
+    return '%s:%d:%s' % (os.path.basename(filename), line, name)
+
+def collapse(stats, max_depth=64):
+    '''
+    collapsed stacks "root;caller;callee microseconds" estimated from the
+    caller graph of pstats, time of a function is split over its callers by
+    their share of its cumulative time
+    
+    >>> def leaf():
+    ...     return sum(range(100000))
+    >>> def root():
+    ...     return leaf() + leaf()
+    >>> p = cProfile.Profile()
+    >>> r = p.runcall(root)
+    >>> lines = collapse(pstats.Stats(p))
+    >>> any(':root;' in line and ':leaf' in line for line in lines)
+    True
+    '''
+    entries = stats.stats
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in entries.iteritems():
+        for caller, edge in callers.iteritems():
+            callees.setdefault(caller, []).append((func, edge[3]))
+    roots = [ func for func, entry in entries.iteritems() if not entry[4] ]
+    samples = {}
+    
+    def walk(func, stack, ratio, depth):
+        cc, nc, tt, ct, callers = entries[func]
+        stack = stack + [_func_name(func)]
+        key = ';'.join(stack)
+        samples[key] = samples.get(key, 0.0) + tt * ratio
+        if depth >= max_depth:
+            return
+        for callee, edge_ct in callees.get(func, []):
+            # recursion is already accounted in cumulative time
+            if callee == func or _func_name(callee) in stack:
+                continue
+            callee_ct = entries[callee][3]
+            if callee_ct > 0 and edge_ct > 0:
+                walk(callee, stack, ratio * edge_ct / callee_ct, depth + 1)
+    
+    for func in roots:
+        walk(func, [], 1.0, 0)
+    return [ '%s %d' % (key, int(value * 1e6)) for key, value in sorted(samples.iteritems()) if int(value * 1e6) > 0 ]
+
+def top_functions(stats, limit=10):
+    '''
+    list of (function, calls, own seconds, cumulative seconds) by own time
+    '''
+    L = [ (_func_name(func), nc, tt, ct) for func, (cc, nc, tt, ct, callers) in stats.stats.iteritems() ]
+    L.sort(key=lambda x: x[2], reverse=True)
+    return L[:limit]
+
+class Profiler(object):
+    '''
+    captures stored in directory, only the newest keep captures are kept
+    
+    >>> import tempfile
+    >>> profiler = Profiler(tempfile.mkdtemp())
+    >>> p = profiler.start()
+    >>> n = sum(range(1000))
+    >>> name = profiler.save(p, 'GET /blog/:id', 0.01)
+    >>> captures = profiler.captures()
+    >>> captures[0]['name'] == name, captures[0]['label']
+    (True, u'GET /blog/:id')
+    >>> os.path.isfile(profiler.path(name, 'collapsed'))
+    True
+    >>> profiler.path('../etc/passwd', 'prof')
+    '''
+    def __init__(self, directory, keep=50):
+        self._directory = directory
+        self._keep = keep
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    
+    def start(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+    
+    def path(self, name, ext):
+        '''
+        file of capture, None if name is not a capture name
+        '''
+        if _RE_LABEL.search(name):
+            return None
+        return os.path.join(self._directory, '%s.%s' % (name, ext))
+    
+    def save(self, profile, label, seconds):
+        '''
+        stop profile and write capture, return capture name
+        '''
+        profile.disable()
+        stats = pstats.Stats(profile)
+        name = '%d-%d-%s' % (int(time.time() * 1000), os.getpid(), _RE_LABEL.sub('_', label).strip('_')[:64])
+        stats.dump_stats(self.path(name, 'prof'))
+        with open(self.path(name, 'collapsed'), 'w') as f:
+            f.write('\n'.join(collapse(stats)))
+            f.write('\n')
+        summary = dict(name=name, label=label, seconds=seconds, created_at=time.time(), top=top_functions(stats))
+        with open(self.path(name, 'json'), 'w') as f:
+            json.dump(summary, f)
+        self._rotate()
+        logging.info('[PROFILE] [saved %s in %s]' % (label, name))
+        return name
+    
+    def _names(self):
+        return sorted([ f[:-5] for f in os.listdir(self._directory) if f.endswith('.json') ], reverse=True)
+    
+    def _rotate(self):
+        with self._lock:
+            for name in self._names()[self._keep:]:
+                for ext in ('json', 'prof', 'collapsed'):
+                    try:
+                        os.remove(self.path(name, ext))
+                    except OSError:
+                        pass
+    
+    def captures(self, limit=20):
+        '''
+        summaries of newest captures
+        '''
+        L = []
+        for name in self._names()[:limit]:
+            try:
+                with open(self.path(name, 'json')) as f:
+                    L.append(json.load(f))
+            except (IOError, ValueError):
+                pass
+        return L
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+token bucket rate limiting, a bucket is kept as one float, the time it
+becomes full again (GCRA), in a process dict swept periodically or in an
+mmap hash table shared by pre-forked workers
+'''
+
+import fcntl
+import hashlib
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+_RE_RATE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*/\s*(s|m|h|d)\w*\s*$')
+
+_PERIODS = dict(s=1, m=60, h=3600, d=86400)
+
+def parse_rate(rate):
+    '''
+    parse "count/period" as requests per second
+    
+    >>> parse_rate('10/m')
+    0.16666666666666666
+    >>> parse_rate('2/s')
+    2.0
+    >>> parse_rate(0.5)
+    0.5
+    >>> parse_rate('often')
+    Traceback (most recent call last):
+      ...
+    ValueError: Invalid rate: often
+    '''
+    if isinstance(rate, (int, long, float)):
+        return float(rate)
+    m = _RE_RATE.match(rate)
+    if m is None:
+        raise ValueError('Invalid rate: %s' % rate)
+    return float(m.group(1)) / _PERIODS[m.group(2)]
+
+def _take(tat, now, rate, burst):
+    '''
+    return (new tat, seconds to wait), wait is 0 when a token is taken
+    '''
+    interval = 1.0 / rate
+    tat = max(tat, now)
+    wait = tat - now - (burst - 1) * interval
+    if wait > 0:
+        return None, wait
+    return tat + interval, 0
+
+class MemoryBuckets(object):
+    '''
+    buckets of current process, full buckets are dropped every sweep_interval
+    
+    >>> b = MemoryBuckets()
+    >>> [ b.take('k', 1, 2, now=100.0) for i in range(3) ]
+    [0, 0, 1.0]
+    >>> b.take('k', 1, 2, now=101.0)
+    0
+    >>> b.take('other', 1, 2, now=101.0)
+    0
+    >>> b.sweep(now=103.0)
+    >>> len(b)
+    0
+    '''
+    def __init__(self, sweep_interval=60):
+        self._tats = {}
+        self._lock = threading.Lock()
+        self._sweep_interval = sweep_interval
+        self._next_sweep = time.time() + sweep_interval
+    
+    def __len__(self):
+        return len(self._tats)
+    
+    def take(self, key, rate, burst, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            tat, wait = _take(self._tats.get(key, now), now, rate, burst)
+            if tat is not None:
+                self._tats[key] = tat
+        if now >= self._next_sweep:
+            self.sweep(now)
+        return wait
+    
+    def sweep(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self._next_sweep = now + self._sweep_interval
+            for key in [ k for k, tat in self._tats.iteritems() if tat <= now ]:
+                del self._tats[key]
+
+class SharedBuckets(object):
+    '''
+    buckets in an mmap file shared by processes, slots of (key hash, tat)
+    are probed linearly and full buckets are reused, a full neighbourhood
+    evicts the bucket closest to full
+    
+    >>> import tempfile
+    >>> b = SharedBuckets(os.path.join(tempfile.mkdtemp(), 'buckets'), slots=64)
+    >>> [ b.take('k', 1, 2, now=100.0) for i in range(3) ]
+    [0, 0, 1.0]
+    >>> b.take('k', 1, 2, now=101.0)
+    0
+    '''
+    _SLOT = struct.Struct('Qd')
+    _PROBES = 8
+    
+    def __init__(self, path, slots=65536):
+        self._slots = slots
+        self._lock = threading.Lock()
+        size = slots * SharedBuckets._SLOT.size
+        self._file = open(path, 'a+b')
+        if os.fstat(self._file.fileno()).st_size != size:
+            self._file.truncate(size)
+        self._mm = mmap.mmap(self._file.fileno(), size)
+    
+    def take(self, key, rate, burst, now=None):
+        now = time.time() if now is None else now
+        h = struct.unpack('Q', hashlib.md5(key).digest()[:8])[0] or 1
+        slot = SharedBuckets._SLOT
+        with self._lock:
+            # record lock excludes other processes, threads hold self._lock
+            fcntl.lockf(self._file, fcntl.LOCK_EX)
+            try:
+                found = free = victim = None
+                for i in range(SharedBuckets._PROBES):
+                    offset = ((h + i) % self._slots) * slot.size
+                    kh, tat = slot.unpack_from(self._mm, offset)
+                    if kh == h:
+                        found = (offset, tat)
+                        break
+                    if free is None and (kh == 0 or tat <= now):
+                        free = offset
+                    if victim is None or tat < victim[1]:
+                        victim = (offset, tat)
+                if found is None:
+                    found = (victim[0] if free is None else free, now)
+                offset = found[0]
+                new_tat, wait = _take(found[1], now, rate, burst)
+                if new_tat is not None:
+                    slot.pack_into(self._mm, offset, h, new_tat)
+                return wait
+            finally:
+                fcntl.lockf(self._file, fcntl.LOCK_UN)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,586 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+pre-fork HTTP/1.1 WSGI server
+
+The master process binds the listening socket (TCP, or a unix socket for the
+nginx upstream), loads the application once and forks workers which share
+its memory copy-on-write. Each worker polls the listening socket and its idle
+keep-alive connections in its main thread and hands a connection to a fixed
+pool of threads only while a request is served.
+'''
+
+import BaseHTTPServer
+import Queue
+import collections
+import errno
+import gc
+import logging
+import multiprocessing
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+import urllib
+from wsgiref.util import FileWrapper
+
+# python 2 has no constant, value of linux
+_SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+_MAX_REQUEST_LINE = 65536
+_MAX_DRAIN_SIZE = 65536
+
+def _bind(host, port, unix_socket=None, reuse_port=False, backlog=1024):
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.unlink(unix_socket)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(unix_socket)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, _SO_REUSEPORT, 1)
+        sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+class _Input(object):
+    '''
+    wsgi.input limited to Content-Length, so the next request on a keep-alive
+    connection starts where this body ends
+    
+    >>> from StringIO import StringIO
+    >>> i = _Input(StringIO('a=1\\nb=2NEXT'), 7)
+    >>> i.readline()
+    'a=1\\n'
+    >>> i.read()
+    'b=2'
+    >>> i.read()
+    ''
+    '''
+    def __init__(self, rfile, length):
+        self._rfile = rfile
+        self.remaining = length
+    
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return ''
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self._rfile.read(size)
+        self.remaining = self.remaining - len(data)
+        return data
+    
+    def readline(self, size=-1):
+        if self.remaining <= 0:
+            return ''
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self._rfile.readline(size)
+        self.remaining = self.remaining - len(data)
+        return data
+    
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, ''))
+    
+    def __iter__(self):
+        return iter(self.readline, '')
+    
+    def drain(self):
+        '''
+        skip unread body, False if too large to be worth keeping connection
+        '''
+        if self.remaining > _MAX_DRAIN_SIZE:
+            return False
+        while self.read(8192):
+            pass
+        return True
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    keep-alive connection, each serve_one() call serves one request so the
+    connection waits between requests in the worker poll loop, not a thread
+    '''
+    protocol_version = 'HTTP/1.1'
+    
+    def __init__(self, request, client_address, server):
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.setup()
+    
+    def serve_one(self):
+        '''
+        serve one request, True if the connection is kept alive
+        '''
+        self.close_connection = 1
+        self.handle_one_request()
+        return not self.close_connection
+    
+    def pending(self):
+        '''
+        True if a pipelined request is already buffered
+        '''
+        buf = self.rfile._rbuf
+        buf.seek(0, 2)
+        return buf.tell() > 0
+    
+    def fileno(self):
+        return self.connection.fileno()
+    
+    def close(self):
+        self.finish()
+        _close(self.connection)
+    
+    def setup(self):
+        self.timeout = self.server.keepalive
+        self.disable_nagle_algorithm = self.server.tcp
+        self.wbufsize = -1
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(_MAX_REQUEST_LINE + 1)
+            if not self.raw_requestline:
+                self.close_connection = 1
+                return
+            if len(self.raw_requestline) > _MAX_REQUEST_LINE:
+                self.send_error(414)
+                return
+            if not self.parse_request():
+                return
+            if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                # nginx always sends Content-Length to upstream
+                self.send_error(411)
+                return
+            if self.headers.get('Expect', '').lower() == '100-continue':
+                self.wfile.write('HTTP/1.1 100 Continue\r\n\r\n')
+                self.wfile.flush()
+            self._run_wsgi()
+        except socket.timeout:
+            # idle keep-alive connection
+            self.close_connection = 1
+        except socket.error, e:
+            self.close_connection = 1
+            if e.args[0] not in (errno.EPIPE, errno.ECONNRESET):
+                logging.warning('[SERVER] [socket error: %s]' % e)
+    
+    def _environ(self):
+        path, sep, query = self.path.partition('?')
+        length = int(self.headers.get('Content-Length') or 0)
+        env = {
+            'REQUEST_METHOD': self.command,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.server.host,
+            'SERVER_PORT': str(self.server.port),
+            'SERVER_PROTOCOL': self.request_version,
+            'REMOTE_ADDR': self.client_address[0] if self.server.tcp else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': _Input(self.rfile, length),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileWrapper,
+        }
+        if length:
+            env['CONTENT_LENGTH'] = str(length)
+        content_type = self.headers.typeheader
+        if content_type:
+            env['CONTENT_TYPE'] = content_type
+        for h in self.headers.headers:
+            k, sep, v = h.partition(':')
+            k = k.strip().replace('-', '_').upper()
+            if k in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                continue
+            k = 'HTTP_' + k
+            v = v.strip()
+            if k in env:
+                env[k] = '%s,%s' % (env[k], v)
+            else:
+                env[k] = v
+        return env
+    
+    def _run_wsgi(self):
+        environ = self._environ()
+        state = dict(status=None, headers=None, sent=False, chunked=False, body=True)
+        
+        def start_response(status, headers, exc_info=None):
+            if exc_info:
+                try:
+                    if state['sent']:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                finally:
+                    exc_info = None
+            state['status'] = status
+            state['headers'] = headers
+            return write
+        
+        def send_headers():
+            status, headers = state['status'], state['headers']
+            code = int(status[:3])
+            state['body'] = self.command != 'HEAD' and code >= 200 and code not in (204, 304)
+            if state['body'] and not [ k for k, v in headers if k.lower() == 'content-length' ]:
+                if self.request_version == 'HTTP/1.1':
+                    state['chunked'] = True
+                else:
+                    self.close_connection = 1
+            L = [ '%s %s\r\n' % (self.protocol_version, status) ]
+            for k, v in headers:
+                L.append('%s: %s\r\n' % (k, v))
+            L.append('Date: %s\r\n' % self.date_time_string())
+            if state['chunked']:
+                L.append('Transfer-Encoding: chunked\r\n')
+            if self.close_connection:
+                L.append('Connection: close\r\n')
+            L.append('\r\n')
+            self.wfile.write(''.join(L))
+            state['sent'] = True
+            self.log_request(code)
+        
+        def write(data):
+            if not state['sent']:
+                send_headers()
+            if data and state['body']:
+                if state['chunked']:
+                    self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+                else:
+                    self.wfile.write(data)
+        
+        try:
+            result = self.server.app(environ, start_response)
+        except Exception, e:
+            logging.exception(e)
+            self.close_connection = 1
+            self.send_error(500)
+            return
+        try:
+            if isinstance(result, (list, tuple)):
+                # buffered body, send with Content-Length and one flush
+                if self.command != 'HEAD' and not [ k for k, v in state['headers'] if k.lower() == 'content-length' ]:
+                    state['headers'] = list(state['headers']) + [('Content-Length', str(sum(map(len, result))))]
+                for data in result:
+                    write(data)
+            else:
+                for data in result:
+                    write(data)
+                    # streamed body reaches client chunk by chunk
+                    self.wfile.flush()
+            if not state['sent']:
+                send_headers()
+            if state['chunked']:
+                self.wfile.write('0\r\n\r\n')
+            self.wfile.flush()
+        except socket.error:
+            raise
+        except Exception, e:
+            logging.exception(e)
+            self.close_connection = 1
+            if not state['sent']:
+                self.send_error(500)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        if not environ['wsgi.input'].drain():
+            self.close_connection = 1
+    
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+    
+    def log_message(self, format, *args):
+        logging.debug('[SERVER] [%s] [%s]' % (self.address_string(), format % args))
+
+class _ServerInfo(object):
+
+    def __init__(self, app, host, port, tcp, keepalive):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.tcp = tcp
+        self.keepalive = keepalive
+
+def _close(conn):
+    try:
+        conn.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+    conn.close()
+
+class _Worker(object):
+    '''
+    idle keep-alive connections wait in a poll loop of the main thread and a
+    connection takes a thread only while a request is being served, so idle
+    upstream connections cannot hold every thread
+    
+    >>> def app(environ, start_response):
+    ...     start_response('200 OK', [('Content-Length', '2')])
+    ...     return ['ok']
+    >>> sock = _bind('127.0.0.1', 0)
+    >>> port = sock.getsockname()[1]
+    >>> w = _Worker(sock, _ServerInfo(app, '127.0.0.1', port, True, 30), 2)
+    >>> t = threading.Thread(target=w.run)
+    >>> t.start()
+    >>> def get(c):
+    ...     c.sendall('GET / HTTP/1.1\\r\\nHost: x\\r\\n\\r\\n')
+    ...     return c.recv(4096).endswith('ok')
+    >>> idle = [ socket.create_connection(('127.0.0.1', port)) for i in range(4) ]
+    >>> [ get(c) for c in idle ]
+    [True, True, True, True]
+    >>> start = time.time()
+    >>> get(socket.create_connection(('127.0.0.1', port))), time.time() - start < 1
+    (True, True)
+    >>> get(idle[0])
+    True
+    >>> w.stop()
+    >>> t.join(5)
+    >>> w.close(5) > 0
+    True
+    '''
+    def __init__(self, sock, info, threads):
+        self._sock = sock
+        self._info = info
+        self._threads = threads
+        self._stopping = threading.Event()
+        self._work = Queue.Queue()
+        self._done = collections.deque()
+        self._wake_r, self._wake_w = os.pipe()
+        self._poller = select.poll()
+        self._idle = {}
+        self._busy = 0
+        self._pool = [ threading.Thread(target=self._handle, name='worker-%d' % n) for n in range(threads) ]
+    
+    def _wake(self):
+        try:
+            os.write(self._wake_w, 'x')
+        except OSError:
+            pass
+    
+    def _handle(self):
+        while True:
+            handler = self._work.get()
+            if handler is None:
+                return
+            keep = False
+            try:
+                keep = handler.serve_one()
+                while keep and handler.pending() and not self._stopping.is_set():
+                    keep = handler.serve_one()
+            except Exception, e:
+                logging.exception(e)
+                keep = False
+            if not keep or self._stopping.is_set():
+                handler.close()
+                handler = None
+            # back to poll loop, which also counts the thread as free
+            self._done.append(handler)
+            self._wake()
+    
+    def _accept(self):
+        try:
+            conn, addr = self._sock.accept()
+        except socket.error, e:
+            # taken by another worker
+            if e.args[0] in (errno.EINTR, errno.EAGAIN, errno.ECONNABORTED):
+                return
+            raise
+        conn.setblocking(1)
+        try:
+            handler = _RequestHandler(conn, addr if self._info.tcp else ('', 0), self._info)
+        except socket.error:
+            _close(conn)
+            return
+        self._add_idle(handler)
+    
+    def _add_idle(self, handler):
+        fd = handler.fileno()
+        self._idle[fd] = (handler, time.time())
+        self._poller.register(fd, select.POLLIN)
+    
+    def _remove_idle(self, fd):
+        self._poller.unregister(fd)
+        return self._idle.pop(fd)[0]
+    
+    def _collect(self):
+        while self._done:
+            handler = self._done.popleft()
+            self._busy = self._busy - 1
+            if handler is not None:
+                self._add_idle(handler)
+    
+    def _expire(self):
+        deadline = time.time() - self._info.keepalive
+        for fd in [ fd for fd, (h, since) in self._idle.iteritems() if since < deadline ]:
+            self._remove_idle(fd).close()
+    
+    def run(self):
+        '''
+        accept and dispatch connections until stop()
+        '''
+        for t in self._pool:
+            t.daemon = True
+            t.start()
+        self._sock.setblocking(0)
+        listen_fd = self._sock.fileno()
+        self._poller.register(listen_fd, select.POLLIN)
+        self._poller.register(self._wake_r, select.POLLIN)
+        while not self._stopping.is_set():
+            events = []
+            try:
+                if self._busy >= self._threads:
+                    # all threads busy: stop accepting, other workers take the load
+                    if select.select([self._wake_r], [], [], 1.0)[0]:
+                        os.read(self._wake_r, 4096)
+                else:
+                    # wake up every second to check stopping and idle timeouts
+                    events = self._poller.poll(1000)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+            for fd, event in events:
+                if fd == self._wake_r:
+                    os.read(self._wake_r, 4096)
+                elif fd == listen_fd:
+                    if self._busy < self._threads:
+                        self._accept()
+                elif fd in self._idle:
+                    if not event & select.POLLIN:
+                        self._remove_idle(fd).close()
+                    elif self._busy < self._threads:
+                        self._busy = self._busy + 1
+                        self._work.put(self._remove_idle(fd))
+            self._collect()
+            self._expire()
+        self._poller.unregister(listen_fd)
+        self._sock.close()
+    
+    def stop(self):
+        self._stopping.set()
+        self._wake()
+    
+    def close(self, graceful_timeout):
+        '''
+        close idle connections and wait for busy ones, return deadline
+        '''
+        for fd in self._idle.keys():
+            self._remove_idle(fd).close()
+        for t in self._pool:
+            self._work.put(None)
+        deadline = time.time() + graceful_timeout
+        for t in self._pool:
+            t.join(max(deadline - time.time(), 0))
+        while self._done:
+            handler = self._done.popleft()
+            if handler is not None:
+                handler.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+        return deadline
+
+def _run_worker(sock, info, threads, graceful_timeout):
+    worker = _Worker(sock, info, threads)
+    def _stop(signum, frame):
+        worker.stop()
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    logging.info('[SERVER] [worker %s started with %d threads]' % (os.getpid(), threads))
+    worker.run()
+    deadline = worker.close(graceful_timeout)
+    # application finishes its background work in the time left
+    shutdown = getattr(info.app, 'shutdown', None)
+    if shutdown:
+        shutdown(max(deadline - time.time(), 0))
+    logging.info('[SERVER] [worker %s stopped]' % os.getpid())
+
+def serve(app, host='127.0.0.1', port=9000, workers=0, threads=8, unix_socket=None, reuse_port=False, keepalive=5, backlog=1024, graceful_timeout=10):
+    '''
+    serve wsgi application by pre-forked workers until SIGTERM or SIGINT,
+    workers=0 uses one worker per CPU, reuse_port binds a socket in every
+    worker with SO_REUSEPORT and lets the kernel balance connections
+    '''
+    workers = workers or multiprocessing.cpu_count()
+    tcp = not unix_socket
+    reuse_port = reuse_port and tcp
+    sock = None if reuse_port else _bind(host, port, unix_socket, False, backlog)
+    info = _ServerInfo(app, host, port, tcp, keepalive)
+    logging.info('[SERVER] [listen on %s with %d workers]' % (unix_socket or '%s:%s' % (host, port), workers))
+    # application is loaded, keep its objects out of collections so pages
+    # stay shared with workers
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    children = set()
+    
+    def _spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _run_worker(sock or _bind(host, port, None, True, backlog), info, threads, graceful_timeout)
+            except Exception, e:
+                logging.exception(e)
+                code = 1
+            finally:
+                os._exit(code)
+        children.add(pid)
+    
+    stopping = []
+    def _stop(signum, frame):
+        stopping.append(signum)
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    for n in range(workers):
+        _spawn()
+    while not stopping:
+        try:
+            pid, status = os.waitpid(-1, 0)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if pid in children:
+            children.discard(pid)
+            if not stopping:
+                logging.warning('[SERVER] [worker %s exited with status %s, restart]' % (pid, status))
+                # avoid busy loop if workers die at once
+                time.sleep(0.1)
+                _spawn()
+    logging.info('[SERVER] [stopping %d workers...]' % len(children))
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    deadline = time.time() + graceful_timeout + 1
+    while children and time.time() < deadline:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError:
+            break
+        if pid:
+            children.discard(pid)
+        else:
+            time.sleep(0.1)
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+    if sock:
+        sock.close()
+    if unix_socket and os.path.exists(unix_socket):
+        os.unlink(unix_socket)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+stateless sessions: fields are carried in the cookie, signed by
+HMAC-SHA256 with a versioned key so keys can be rotated, and verified in
+memory without looking up a session store
+'''
+
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import time
+
+from tool import SimpleDict
+
+def _b64encode(s):
+    return base64.urlsafe_b64encode(s).rstrip('=')
+
+def _b64decode(s):
+    return base64.urlsafe_b64decode(s + '=' * (-len(s) % 4))
+
+class SessionCodec(object):
+    '''
+    encode dict as "version.payload.signature", payload is base64 of json
+    with expire time, signature covers version and payload
+    
+    >>> codec = SessionCodec({1: 'old-secret', 2: 'new-secret'}, 2)
+    >>> value = codec.encode(dict(id='u1', admin=True), max_age=60, now=1000.0)
+    >>> value.split('.')[0]
+    '2'
+    >>> s = codec.decode(value, now=1030.0)
+    >>> s.id, s.admin, s.exp, s.kv
+    (u'u1', True, 1060, '2')
+    >>> codec.decode(value, now=1061.0) is None
+    True
+    >>> codec.decode(value.replace('2.', '1.', 1), now=1030.0) is None
+    True
+    >>> codec.decode('garbage') is None
+    True
+    >>> codec.decode(u'1.abc.d\xe9f') is None
+    True
+    >>> codec.decode(unicode(value), now=1030.0).id
+    u'u1'
+    >>> old = SessionCodec({1: 'old-secret'}, 1).encode(dict(id='u2'), now=1000.0)
+    >>> codec.decode(old, now=1030.0).id
+    u'u2'
+    >>> SessionCodec({2: 'new-secret'}).decode(old, now=1030.0) is None
+    True
+    '''
+    def __init__(self, secrets, version=None, max_age=86400):
+        self._secrets = dict([ (str(v), s) for v, s in secrets.iteritems() ])
+        self._version = str(max(secrets) if version is None else version)
+        if self._version not in self._secrets:
+            raise ValueError('No secret for key version: %s' % self._version)
+        self._max_age = max_age
+    
+    def _sign(self, version, payload):
+        return _b64encode(hmac.new(self._secrets[version], '%s.%s' % (version, payload), hashlib.sha256).digest())
+    
+    def fingerprint(self, value, version=None):
+        '''
+        short keyed digest of value, lets a session be tied to a secret like
+        the password without revealing it
+        
+        >>> codec = SessionCodec({1: 'secret'})
+        >>> len(codec.fingerprint('password'))
+        16
+        >>> codec.fingerprint('password') == codec.fingerprint('password', 1)
+        True
+        '''
+        version = self._version if version is None else str(version)
+        return hmac.new(self._secrets[version], 'fp.%s' % value, hashlib.sha256).hexdigest()[:16]
+    
+    def encode(self, data, max_age=None, now=None):
+        '''
+        sign data, which must be json serializable, valid for max_age seconds
+        '''
+        now = time.time() if now is None else now
+        d = dict(data)
+        d['exp'] = int(now + (max_age or self._max_age))
+        payload = _b64encode(json.dumps(d, separators=(',', ':')))
+        return '%s.%s.%s' % (self._version, payload, self._sign(self._version, payload))
+    
+    def decode(self, value, now=None):
+        '''
+        return SimpleDict of signed data with key version as kv, None if the
+        value is malformed, badly signed or expired
+        '''
+        try:
+            # cookies are unquoted to unicode, a valid value is plain ascii
+            version, payload, signature = value.encode('ascii').split('.')
+        except (ValueError, AttributeError, UnicodeError):
+            return None
+        if version not in self._secrets:
+            return None
+        if not hmac.compare_digest(signature, self._sign(version, payload)):
+            return None
+        try:
+            d = SimpleDict(**json.loads(_b64decode(payload)))
+        except (ValueError, TypeError):
+            return None
+        if d.get('exp', 0) < (time.time() if now is None else now):
+            return None
+        d.kv = version
+        return d
+
+class RevocationCache(object):
+    '''
+    cache load(key) for ttl seconds, so a change made in the database, such
+    as a password change, revokes sessions checked against it within ttl
+    seconds at the cost of one load per key per ttl
+    
+    >>> calls = []
+    >>> def load(key):
+    ...     calls.append(key)
+    ...     return key.upper()
+    >>> c = RevocationCache(10, load)
+    >>> c.get('a', now=100.0), c.get('a', now=105.0), c.get('a', now=111.0)
+    ('A', 'A', 'A')
+    >>> calls
+    ['a', 'a']
+    >>> c.forget('a')
+    >>> c.get('a', now=112.0)
+    'A'
+    >>> len(calls)
+    3
+    >>> c.peek('a', now=113.0), c.peek('b', now=113.0), len(calls)
+    ('A', None, 3)
+    '''
+    def __init__(self, ttl, load, max_size=10000):
+        self._ttl = ttl
+        self._load = load
+        self._max_size = max_size
+        self._entries = {}
+        self._lock = threading.Lock()
+    
+    def get(self, key, now=None):
+        now = time.time() if now is None else now
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        value = self._load(key)
+        with self._lock:
+            if len(self._entries) >= self._max_size:
+                for k in [ k for k, e in self._entries.iteritems() if e[0] <= now ]:
+                    del self._entries[k]
+                if len(self._entries) >= self._max_size:
+                    self._entries.clear()
+            self._entries[key] = (now + self._ttl, value)
+        return value
+    
+    def peek(self, key, now=None):
+        '''
+        cached value of key, None if it is not cached, never calls load
+        '''
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > (time.time() if now is None else now):
+            return entry[1]
+        return None
+    
+    def forget(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+background tasks on a bounded pool of threads, which are greenlets once
+gevent has patched threading, failed tasks are retried with backoff and
+the pool is drained before the process exits
+'''
+
+import atexit
+import logging
+import os
+import Queue
+import threading
+import time
+
+def _task_name(fn):
+    return getattr(fn, '__name__', repr(fn))
+
+class TaskPool(object):
+    '''
+    threads are started by the first submit in each process, so a pool
+    created before workers are forked works in every worker
+    
+    >>> results = []
+    >>> def flaky(n):
+    ...     results.append(n)
+    ...     if len(results) < 2:
+    ...         raise ValueError('try again')
+    >>> pool = TaskPool(size=2, retries=1, backoff=0.01)
+    >>> pool.submit(flaky, (1,))
+    True
+    >>> pool.drain(1.0)
+    True
+    >>> results
+    [1, 1]
+    >>> pool.submit(flaky, (2,))
+    False
+    '''
+    def __init__(self, size=4, queue_size=1000, retries=2, backoff=0.5, drain_timeout=10, on_depth=None):
+        self._size = size
+        self._queue_size = queue_size
+        self._retries = retries
+        self._backoff = backoff
+        self._drain_timeout = drain_timeout
+        self._on_depth = on_depth
+        self._queue = None
+        self._pid = None
+        self._closed = False
+        self._lock = threading.Lock()
+    
+    def _start(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._queue = Queue.Queue(self._queue_size)
+            for n in range(self._size):
+                t = threading.Thread(target=self._work, name='task-%d' % n)
+                t.daemon = True
+                t.start()
+            atexit.register(self.drain, self._drain_timeout)
+            self._pid = pid
+    
+    def _report(self):
+        if self._on_depth:
+            self._on_depth(self._queue.qsize())
+    
+    def submit(self, fn, args=(), kw=None):
+        '''
+        queue fn(*args, **kw), False if pool is draining or queue is full
+        '''
+        if self._closed:
+            logging.warning('[TASK] [pool is draining, drop %s]' % _task_name(fn))
+            return False
+        self._start()
+        try:
+            self._queue.put_nowait((fn, args, kw or {}))
+        except Queue.Full:
+            logging.warning('[TASK] [queue is full, drop %s]' % _task_name(fn))
+            return False
+        self._report()
+        return True
+    
+    def _work(self):
+        while True:
+            fn, args, kw = self._queue.get()
+            try:
+                self._report()
+                self._run(fn, args, kw)
+            finally:
+                self._queue.task_done()
+    
+    def _run(self, fn, args, kw):
+        attempt = 0
+        while True:
+            try:
+                fn(*args, **kw)
+                return
+            except Exception:
+                if attempt >= self._retries:
+                    logging.exception('[TASK] [%s failed after %d attempts]' % (_task_name(fn), attempt + 1))
+                    return
+                attempt = attempt + 1
+                logging.warning('[TASK] [%s failed, retry %d]' % (_task_name(fn), attempt))
+                time.sleep(self._backoff * 2 ** (attempt - 1))
+    
+    def drain(self, timeout=None):
+        '''
+        stop accepting tasks and wait for queued ones, False on timeout
+        '''
+        self._closed = True
+        if self._pid != os.getpid():
+            return True
+        timeout = self._drain_timeout if timeout is None else timeout
+        deadline = time.time() + timeout
+        q = self._queue
+        with q.all_tasks_done:
+            while q.unfinished_tasks:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logging.warning('[TASK] [%d tasks left undone]' % q.unfinished_tasks)
+                    return False
+                q.all_tasks_done.wait(remaining)
+        return True
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -7,6 +7,8 @@ tools for transwarp
 
 import datetime
 import re
+import sys
+import threading
 
 class SimpleDict(dict):
     '''
@@ -112,6 +114,78 @@ class UTC(datetime.tzinfo):
     
     __repr__ = __str__
 
+# context local storage for threads and greenlets
+
+def green():
+    '''
+    check if gevent has patched threading, then requests run in greenlets
+    
+    >>> green()
+    False
+    '''
+    if 'gevent.monkey' in sys.modules:
+        from gevent import monkey
+        return monkey.is_module_patched('threading')
+    return False
+
+def _local_class():
+    if green():
+        from gevent.local import local
+        return local
+    return threading.local
+
+class ContextLocal(object):
+    '''
+    proxy to an object created by factory for each thread, or for each
+    greenlet when gevent has patched threading, storage is chosen on first
+    use so it does not depend on importing before or after patch_all()
+    
+    >>> class Holder(object):
+    ...     def __init__(self):
+    ...         self.value = 0
+    >>> c = ContextLocal(Holder)
+    >>> c.value
+    0
+    >>> c.value = 1
+    >>> def other():
+    ...     c.value = 2
+    >>> t = threading.Thread(target=other)
+    >>> t.start()
+    >>> t.join()
+    >>> c.value
+    1
+    >>> c.name = 'a'
+    >>> del c.name
+    >>> hasattr(c, 'name')
+    False
+    '''
+    def __init__(self, factory):
+        self.__dict__['_factory'] = factory
+        self.__dict__['_local'] = None
+        self.__dict__['_lock'] = threading.Lock()
+    
+    def _current(self):
+        local = self.__dict__['_local']
+        if local is None:
+            with self.__dict__['_lock']:
+                local = self.__dict__['_local']
+                if local is None:
+                    local = self.__dict__['_local'] = _local_class()()
+        try:
+            return local.value
+        except AttributeError:
+            value = local.value = self.__dict__['_factory']()
+            return value
+    
+    def __getattr__(self, name):
+        return getattr(self._current(), name)
+    
+    def __setattr__(self, name, value):
+        setattr(self._current(), name, value)
+    
+    def __delattr__(self, name):
+        delattr(self._current(), name)
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
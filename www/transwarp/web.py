@@ -5,26 +5,43 @@
 module for web framework
 '''
 
+import calendar
 import cgi
+import collections
 import datetime
+import email.utils
 import functools
+import hashlib
 import json
 import logging
+import math
 import mimetypes
 import os
+import random
 import re
+import stat
 import sys
+import tempfile
 import threading
+import time
 import traceback
 import types
 import urllib
+import zlib
 
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
 
-from tool import SimpleDict, UTC
+import db
+import metrics
+from profiler import Profiler
+from admission import AdmissionController
+from ratelimit import parse_rate, MemoryBuckets, SharedBuckets
+from generations import MemoryGenerations, SharedGenerations
+from tasks import TaskPool
+from tool import SimpleDict, UTC, ContextLocal, green
 
 # response status and headers
 
@@ -80,6 +97,7 @@ _RESPONSE_STATUSES = {
     423: 'Locked',
     424: 'Failed Dependency',
     426: 'Upgrade Required',
+    429: 'Too Many Requests',
     
     # Server Error
     500: 'Internal Server Error',
@@ -337,12 +355,190 @@ class MultipartFile(object):
         self.filename = _to_unicode(storage.filename)
         self.file = storage.file
 
+# define request body parser
+
+# multipart file parts larger than this are spilled to a temp file
+_MULTIPART_SPILL_SIZE = 64 * 1024
+_READ_BLOCK_SIZE = 64 * 1024
+
+def _content_length(environ):
+    '''
+    get content length from environ, None if not set or invalid
+    
+    >>> _content_length({'CONTENT_LENGTH': '12'})
+    12
+    >>> _content_length({'CONTENT_LENGTH': ''})
+    >>> _content_length({})
+    '''
+    length = environ.get('CONTENT_LENGTH')
+    if length and length.isdigit():
+        return int(length)
+    return None
+
+class _BodyReader(object):
+    r'''
+    read request body up to content length, raise 413 if exceeding max size
+    
+    >>> r = _BodyReader(StringIO('a\nbc\nrest'), 5, None)
+    >>> r.readline(), r.readline(), r.readline()
+    ('a\n', 'bc\n', '')
+    >>> _BodyReader(StringIO('0123456789'), None, 4).read()
+    Traceback (most recent call last):
+      ...
+    HttpError: 413 Request Entity Too Large
+    '''
+    def __init__(self, fp, length, max_size):
+        if length is not None and max_size and length > max_size:
+            raise HttpError(413)
+        self._fp = fp
+        self._remaining = length
+        self._max_size = max_size
+        self._total = 0
+    
+    def _limit(self, size):
+        if self._remaining is not None:
+            return min(size, self._remaining)
+        return size
+    
+    def _consume(self, data):
+        if self._remaining is not None:
+            self._remaining = self._remaining - len(data)
+        self._total = self._total + len(data)
+        if self._max_size and self._total > self._max_size:
+            raise HttpError(413)
+        return data
+    
+    def read(self):
+        if self._remaining is not None:
+            return self._consume(self._fp.read(self._remaining))
+        L = []
+        while True:
+            data = self._consume(self._fp.read(_READ_BLOCK_SIZE))
+            if not data:
+                return ''.join(L)
+            L.append(data)
+    
+    def readline(self, size=_READ_BLOCK_SIZE):
+        size = self._limit(size)
+        if size <= 0:
+            return ''
+        return self._consume(self._fp.readline(size))
+
+def _add_input(inputs, key, value):
+    v = inputs.get(key)
+    if v is None:
+        inputs[key] = value
+    elif isinstance(v, list):
+        v.append(value)
+    else:
+        inputs[key] = [v, value]
+
+def _parse_urlencoded(qs, inputs):
+    '''
+    parse urlencoded string into inputs, values are kept as str
+    
+    >>> d = {}
+    >>> _parse_urlencoded('a=1&b=M%20M&c=ABC&c=XYZ&e=', d)
+    >>> sorted(d.items())
+    [('a', '1'), ('b', 'M M'), ('c', ['ABC', 'XYZ']), ('e', '')]
+    '''
+    if ';' in qs:
+        qs = qs.replace(';', '&')
+    for field in qs.split('&'):
+        if not field:
+            continue
+        k, eq, v = field.partition('=')
+        # only unquote when needed, most keys and many values are plain
+        if '%' in k or '+' in k:
+            k = urllib.unquote_plus(k)
+        if '%' in v or '+' in v:
+            v = urllib.unquote_plus(v)
+        _add_input(inputs, k, v)
+
+def _parse_multipart(reader, boundary, inputs):
+    '''
+    parse multipart body line by line, text parts are kept as str and file
+    parts are written to a SpooledTemporaryFile
+    '''
+    sep = '--' + boundary
+    end = sep + '--'
+    line = reader.readline()
+    while line:
+        s = line.rstrip('\r\n')
+        if s == end:
+            return
+        if s == sep:
+            break
+        line = reader.readline()
+    while line:
+        headers = {}
+        while True:
+            line = reader.readline()
+            s = line.rstrip('\r\n')
+            if not s:
+                break
+            k, v = s.split(':', 1) if ':' in s else (s, '')
+            headers[k.strip().lower()] = v.strip()
+        if not line:
+            return
+        disposition, params = cgi.parse_header(headers.get('content-disposition', ''))
+        filename = params.get('filename')
+        fp = StringIO() if filename is None else tempfile.SpooledTemporaryFile(_MULTIPART_SPILL_SIZE)
+        # the line ending before a boundary belongs to the boundary
+        pending = ''
+        while True:
+            line = reader.readline()
+            if not line:
+                break
+            if line.startswith('--'):
+                s = line.rstrip('\r\n')
+                if s == sep or s == end:
+                    break
+            fp.write(pending)
+            if line.endswith('\r\n'):
+                fp.write(line[:-2])
+                pending = '\r\n'
+            elif line.endswith('\n'):
+                fp.write(line[:-1])
+                pending = '\n'
+            else:
+                fp.write(line)
+                pending = ''
+        name = params.get('name')
+        if name is not None:
+            if filename is None:
+                _add_input(inputs, name, fp.getvalue())
+            else:
+                fp.seek(0)
+                _add_input(inputs, name, MultipartFile(SimpleDict(filename=filename, file=fp)))
+        if not line or line.rstrip('\r\n') == end:
+            return
+
+def _decode_input(v):
+    if isinstance(v, str):
+        return _to_unicode(v)
+    if isinstance(v, list):
+        return [ _decode_input(x) for x in v ]
+    return v
+
 class Request(object):
     '''
-    Request object, obtain http request information
+    Request object, obtain http request information, fields are decoded on
+    first access and memoized, interceptors may set user
     '''
-    def __init__(self, environ):
+    __slots__ = ('_environ', '_max_body_size', '_path_info', '_headers', '_cookies', '_body', '_raw_input', 'user')
+    
+    def __init__(self, environ, max_body_size=None):
         self._environ = environ
+        self._max_body_size = max_body_size
+        self._path_info = None
+        self._headers = None
+        self._cookies = None
+        self._body = None
+        self._raw_input = None
+    
+    def _get_body_reader(self):
+        return _BodyReader(self._environ['wsgi.input'], _content_length(self._environ), self._max_body_size)
     
     @property
     def environ(self):
@@ -369,8 +565,9 @@ class Request(object):
         >>> r.get_body()
         '<xml><raw/>'
         '''
-        fp = self._environ['wsgi.input']
-        return fp.read()
+        if self._body is None:
+            self._body = self._get_body_reader().read()
+        return self._body
     
     @property
     def remote_addr(self):
@@ -428,7 +625,9 @@ class Request(object):
         >>> r.path_info
         '/test/a b.html'
         '''
-        return urllib.unquote(self._environ.get('PATH_INFO', ''))
+        if self._path_info is None:
+            self._path_info = urllib.unquote(self._environ.get('PATH_INFO', ''))
+        return self._path_info
     
     @property
     def query_string(self):
@@ -445,7 +644,7 @@ class Request(object):
         return self._environ.get('QUERY_STRING', '')
     
     def _get_headers(self):
-        if not hasattr(self, '_headers'):
+        if self._headers is None:
             hdrs = {}
             for k ,v in self._environ.iteritems():
                 if k.startswith('HTTP_'):
@@ -469,12 +668,18 @@ class Request(object):
         >>> r.header('Test', u'DEFAULT')
         u'DEFAULT'
         '''
-        return self._get_headers().get(header.upper(), default)
+        if self._headers is not None:
+            return self._headers.get(header.upper(), default)
+        # single header is looked up in environ without decoding all of them
+        v = self._environ.get('HTTP_' + header.upper().replace('-', '_'))
+        if v is None:
+            return default
+        return v.decode('utf-8')
     
     @property
     def headers(self):
         '''
-        get all HTTP headers from request
+        get copy of all HTTP headers from request as dict
         
         >>> r = Request({'HTTP_USER_AGENT': 'Mozilla/5.0', 'HTTP_ACCEPT': 'text/html'})
         >>> H = r.headers
@@ -486,12 +691,14 @@ class Request(object):
         >>> L.sort()
         >>> L
         [('ACCEPT', u'text/html'), ('USER-AGENT', u'Mozilla/5.0')]
+        >>> r.headers is H
+        False
         '''
-        return dict(**self._get_headers())
+        return dict(self._get_headers())
     
     def _get_cookies(self):
-        if not hasattr(self, '_cookies'):
-            cookies = {}
+        if self._cookies is None:
+            cookies = SimpleDict()
             cookie_str = self._environ.get('HTTP_COOKIE')
             if cookie_str:
                 for c in cookie_str.split(';'):
@@ -519,7 +726,7 @@ class Request(object):
     @property
     def cookies(self):
         '''
-        get all cookies
+        get copy of all cookies
         
         >>> r = Request({'HTTP_COOKIE':'A=123; url=http%3A%2F%2Fwww.example.com%2F'})
         >>> r.cookies['A']
@@ -530,22 +737,49 @@ class Request(object):
         return SimpleDict(**self._get_cookies())
     
     def _parse_input(self):
+        '''
+        parse query string and form body, values are decoded when accessed
         
-        def _convert(item):
-            if isinstance(item, list):
-                return [ _to_unicode(i.value) for i in item ]
-            if item.filename:
-                return MultipartFile(item)
-            return _to_unicode(item.value)
-        
-        fs = cgi.FieldStorage(fp=self._environ['wsgi.input'], environ=self._environ, keep_blank_values=True)
-        inputs = dict()
-        for key in fs:
-            inputs[key] = _convert(fs[key])
+        >>> r = Request({'REQUEST_METHOD':'POST', 'QUERY_STRING':'page=2', 'CONTENT_TYPE':'application/json', 'wsgi.input':StringIO('{"title":"T","tags":["a","b"]}')})
+        >>> sorted(r._parse_input().items())
+        [('page', '2'), (u'tags', [u'a', u'b']), (u'title', u'T')]
+        >>> r.get_body()
+        '{"title":"T","tags":["a","b"]}'
+        >>> r = Request({'REQUEST_METHOD':'POST', 'CONTENT_LENGTH':'10', 'wsgi.input':StringIO('a=1')}, max_body_size=4)
+        >>> r.get('a')
+        Traceback (most recent call last):
+          ...
+        HttpError: 413 Request Entity Too Large
+        '''
+        inputs = {}
+        qs = self._environ.get('QUERY_STRING')
+        if qs:
+            _parse_urlencoded(qs, inputs)
+        if self._environ.get('REQUEST_METHOD') in ('GET', 'HEAD'):
+            return inputs
+        content_type = self._environ.get('CONTENT_TYPE') or 'application/x-www-form-urlencoded'
+        params = {}
+        if ';' in content_type:
+            content_type, params = cgi.parse_header(content_type)
+        if content_type == 'application/x-www-form-urlencoded':
+            _parse_urlencoded(self.get_body(), inputs)
+        elif content_type == 'application/json':
+            body = self.get_body()
+            try:
+                data = json.loads(body) if body else {}
+            except ValueError:
+                raise badrequesterror()
+            if isinstance(data, dict):
+                inputs.update(data)
+        elif content_type == 'multipart/form-data':
+            boundary = params.get('boundary')
+            if not boundary:
+                raise badrequesterror()
+            _parse_multipart(self._get_body_reader(), boundary, inputs)
         return inputs
     
     def _get_raw_input(self):
-        if not hasattr(self, '_raw_input'):
+        if self._raw_input is None:
             self._raw_input = self._parse_input()
         return self._raw_input
     
@@ -563,10 +797,12 @@ class Request(object):
         >>> r.get('empty', 'DEFAULT')
         'DEFAULT'
         '''
-        r = self._get_raw_input().get(key, default)
+        r = self._get_raw_input().get(key)
+        if r is None:
+            return default
         if isinstance(r, list):
-            return r[0]
-        return r
+            r = r[0]
+        return _decode_input(r)
     
     def gets(self, key):
         '''
@@ -585,8 +821,8 @@ class Request(object):
         '''
         r = self._get_raw_input()[key]
         if isinstance(r, list):
-            return r[:]
-        return [r]
+            return _decode_input(r)
+        return [_decode_input(r)]
     
     def __getitem__(self, key):
         '''
@@ -620,8 +856,8 @@ class Request(object):
         '''
         r = self._get_raw_input()[key]
         if isinstance(r, list):
-            return r[0]
-        return r
+            r = r[0]
+        return _decode_input(r)
     
     def input(self, **kw):
         '''
@@ -649,7 +885,7 @@ class Request(object):
         copy = SimpleDict(**kw)
         raw = self._get_raw_input()
         for k, v in raw.iteritems():
-            copy[k] = v[0] if isinstance(v, list) else v
+            copy[k] = _decode_input(v[0] if isinstance(v, list) else v)
         return copy
 
 # define response container
@@ -686,11 +922,126 @@ def _quote(s, encoding='utf-8'):
         s = s.encode(encoding)
     return urllib.quote(s)
 
+def _http_date(t):
+    '''
+    format timestamp or datetime as http date
+    
+    >>> _http_date(1342274794.123)
+    'Sat, 14 Jul 2012 14:06:34 GMT'
+    >>> _http_date(datetime.datetime(2012, 7, 14, 22, 6, 34, tzinfo=UTC('+8:00')))
+    'Sat, 14 Jul 2012 14:06:34 GMT'
+    '''
+    if isinstance(t, datetime.datetime):
+        if t.tzinfo:
+            t = t.astimezone(UTC_0)
+        t = calendar.timegm(t.timetuple())
+    return email.utils.formatdate(t, usegmt=True)
+
+def _parse_http_date(s):
+    '''
+    parse http date as int timestamp, None if invalid
+    
+    >>> _parse_http_date('Sat, 14 Jul 2012 14:06:34 GMT')
+    1342274794
+    >>> _parse_http_date('Saturday')
+    '''
+    t = email.utils.parsedate_tz(s)
+    if t is None:
+        return None
+    return email.utils.mktime_tz(t)
+
+def _etag_key(etag):
+    '''
+    strip weak prefix and content coding suffix of ETag for comparison
+    
+    >>> _etag_key('W/"abc-gzip"')
+    '"abc"'
+    >>> _etag_key('"abc-br"')
+    '"abc"'
+    '''
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    for suffix in ('-gzip"', '-br"'):
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)] + '"'
+    return etag
+
+def _is_not_modified(environ, etag, last_modified):
+    '''
+    check conditional request headers against validators of response,
+    If-Modified-Since is ignored when If-None-Match is present
+    
+    >>> _is_not_modified({'HTTP_IF_NONE_MATCH': '"abc", W/"def"'}, '"def"', None)
+    True
+    >>> _is_not_modified({'HTTP_IF_NONE_MATCH': '"abc"'}, 'W/"abc"', None)
+    True
+    >>> _is_not_modified({'HTTP_IF_NONE_MATCH': '"abc"'}, '"xyz"', 'Sat, 14 Jul 2012 14:06:34 GMT')
+    False
+    >>> _is_not_modified({'HTTP_IF_NONE_MATCH': '"abc-gzip"'}, '"abc"', None)
+    True
+    >>> _is_not_modified({'HTTP_IF_NONE_MATCH': '*'}, '"xyz"', None)
+    True
+    >>> _is_not_modified({'HTTP_IF_MODIFIED_SINCE': 'Sat, 14 Jul 2012 14:06:34 GMT'}, None, 'Sat, 14 Jul 2012 14:06:34 GMT')
+    True
+    >>> _is_not_modified({'HTTP_IF_MODIFIED_SINCE': 'Sat, 14 Jul 2012 14:06:33 GMT'}, None, 'Sat, 14 Jul 2012 14:06:34 GMT')
+    False
+    >>> _is_not_modified({}, '"abc"', None)
+    False
+    '''
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        if not etag:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        # weak comparison as GET and HEAD allow
+        tag = _etag_key(etag)
+        for t in if_none_match.split(','):
+            if _etag_key(t.strip()) == tag:
+                return True
+        return False
+    if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified:
+        since = _parse_http_date(if_modified_since)
+        modified = _parse_http_date(last_modified)
+        return since is not None and modified is not None and modified <= since
+    return False
+
+def check_modified(etag=None, last_modified=None, weak=True):
+    '''
+    set validators on current response and raise 304 Not Modified if the
+    request already has them, handlers call it before doing expensive work
+    
+    >>> ctx.request = Request({'REQUEST_METHOD': 'GET', 'HTTP_IF_NONE_MATCH': 'W/"001-2"'})
+    >>> ctx.response = Response()
+    >>> check_modified(etag='001-1')
+    >>> ctx.response.header('ETag')
+    'W/"001-1"'
+    >>> check_modified(etag='001-2')
+    Traceback (most recent call last):
+      ...
+    HttpError: 304 Not Modified
+    '''
+    response = ctx.response
+    if etag is not None:
+        response.set_etag(etag, weak)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if ctx.request.request_method in ('GET', 'HEAD') and \
+            _is_not_modified(ctx.request.environ, response.header('ETag'), response.header('Last-Modified')):
+        raise HttpError(304)
+
 class Response(object):
     
+    __slots__ = ('_status', '_headers', '_cookies', '_cache_pending', '_profile', '_deferred')
+    
     def __init__(self):
         self._status = '200 OK'
         self._headers = {'CONTENT-TYPE': 'text/html; charset=utf-8'}
+        self._cookies = None
+        self._cache_pending = None
+        self._profile = None
+        self._deferred = None
     
     @property
     def status(self):
@@ -783,7 +1134,7 @@ class Response(object):
         >>> r._cookies
         {'company': 'company=Expires; Expires=Sat, 14-Jul-2012 14:06:34 GMT; Path=/; HttpOnly'}
         '''
-        if not hasattr(self, '_cookies'):
+        if self._cookies is None:
             self._cookies = {}
         L = [ '%s=%s' % (_quote(name), _quote(value)) ]
         if expires is not None:
@@ -820,7 +1171,7 @@ class Response(object):
         >>> r._cookies
         {}
         '''
-        if hasattr(self, '_cookies'):
+        if self._cookies:
             if name in self._cookies:
                 del self._cookies[name]
     
@@ -885,12 +1236,54 @@ class Response(object):
         [('Content-Type', 'text/html; charset=utf-8'), ('Set-Cookie', 's1=ok; Max-Age=3600; Path=/; HttpOnly'), ('X-Powered-By', 'transwarp/1.0')]
         '''
         L = [ (_RESPONSE_HEADER_DICT.get(k, k), v) for k, v in self._headers.iteritems() ]
-        if hasattr(self, '_cookies'):
+        if self._cookies:
             for v in self._cookies.itervalues():
                 L.append(('Set-Cookie', v))
         L.append(_HEADER_X_POWERED_BY)
         return L
     
+    @property
+    def etag(self):
+        '''
+        get ETag of response
+        
+        >>> r = Response()
+        >>> r.etag
+        >>> r.set_etag('abc')
+        >>> r.etag
+        '"abc"'
+        >>> r.set_etag('abc', weak=True)
+        >>> r.etag
+        'W/"abc"'
+        '''
+        return self.header('ETAG')
+    
+    def set_etag(self, value, weak=False):
+        '''
+        set ETag by opaque value, weak for semantically equal responses
+        '''
+        value = '"%s"' % _to_str(value).replace('"', '')
+        self.set_header('ETAG', 'W/' + value if weak else value)
+    
+    @property
+    def last_modified(self):
+        '''
+        get Last-Modified of response
+        
+        >>> r = Response()
+        >>> r.last_modified = 1342274794.123
+        >>> r.last_modified
+        'Sat, 14 Jul 2012 14:06:34 GMT'
+        '''
+        return self.header('LAST-MODIFIED')
+    
+    @last_modified.setter
+    def last_modified(self, value):
+        '''
+        set Last-Modified by timestamp or datetime
+        '''
+        self.set_header('LAST-MODIFIED', _http_date(value))
+    
     @property
     def content_type(self):
         '''
@@ -945,12 +1338,24 @@ class Response(object):
 
 # define template
 
+# rendered template chunks are joined up to this size before sent
+_STREAM_CHUNK_SIZE = 8192
+
 class TemplateEngine(object):
     '''
     base template engine
     '''
+    # stream rendered templates by default
+    stream = False
+    
     def __call__(self, path, model):
         return '<!-- override this method to render template -->'
+    
+    def generate(self, path, model):
+        '''
+        render template as iterable of str chunks
+        '''
+        yield self(path, model)
 
 class Jinja2TemplateEngine(TemplateEngine):
     '''
@@ -961,18 +1366,64 @@ class Jinja2TemplateEngine(TemplateEngine):
     >>> engine.add_filter('datetime', lambda dt: dt.strftime('%Y-%m-%d %H:%M:%S'))
     >>> engine('test_jinja2.html', dict(name='Michael', posted_at=datetime.datetime(2014, 6, 1, 10, 11, 12)))
     '<p>Hello, Michael.</p><span>2014-06-01 10:11:12</span>'
+    >>> list(engine.generate('test_jinja2.html', dict(name='Michael', posted_at=datetime.datetime(2014, 6, 1, 10, 11, 12))))
+    ['<p>Hello, Michael.</p><span>2014-06-01 10:11:12</span>']
     '''
-    def __init__(self, templ_dir, **kw):
-        from jinja2 import Environment, FileSystemLoader
+    def __init__(self, templ_dir, stream=False, cache_dir=None, compiled_dir=None, **kw):
+        '''
+        init Jinja2 environment, for production pass cache_dir to share an
+        on-disk bytecode cache between workers, compiled_dir to load
+        templates precompiled by compile(), and auto_reload=False
+        '''
+        from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, ModuleLoader, ChoiceLoader
         if not 'autoescape' in kw:
             kw['autoescape'] = True
-        self._env = Environment(loader=FileSystemLoader(templ_dir), **kw)
+        if cache_dir:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            kw['bytecode_cache'] = FileSystemBytecodeCache(cache_dir)
+        loader = FileSystemLoader(templ_dir)
+        if compiled_dir and os.path.isdir(compiled_dir):
+            logging.info('[WEB] [load precompiled templates from %s]' % compiled_dir)
+            loader = ChoiceLoader([ModuleLoader(compiled_dir), loader])
+        self.stream = stream
+        self._templ_dir = templ_dir
+        self._env = Environment(loader=loader, **kw)
     
     def add_filter(self, name, fn_filter):
         self._env.filters[name] = fn_filter
     
+    def compile(self, target):
+        '''
+        precompile all templates as python modules into target directory,
+        filters must be added before compiling
+        '''
+        from jinja2 import FileSystemLoader
+        env = self._env.overlay(loader=FileSystemLoader(self._templ_dir))
+        env.compile_templates(target, zip=None, ignore_errors=False)
+    
     def __call__(self, path, model):
         return self._env.get_template(path).render(**model).encode('utf-8')
+    
+    def generate(self, path, model):
+        # template is loaded before the first chunk, so a missing template
+        # still fails before the response starts
+        template = self._env.get_template(path)
+        return self._generate(template, model)
+    
+    def _generate(self, template, model):
+        L = []
+        size = 0
+        for s in template.generate(**model):
+            s = s.encode('utf-8')
+            L.append(s)
+            size = size + len(s)
+            if size >= _STREAM_CHUNK_SIZE:
+                yield ''.join(L)
+                L = []
+                size = 0
+        if L:
+            yield ''.join(L)
 
 class Template(object):
     '''
@@ -986,12 +1437,16 @@ class Template(object):
     >>> t = Template('test.html', abc=u'ABC', xyz=u'XYZ')
     >>> t.model['abc']
     u'ABC'
+    >>> t.stream
     '''
+    # True or False to override stream setting of template engine
+    stream = None
+    
     def __init__(self, template_name, **kw):
         self.template_name = template_name
         self.model = dict(**kw)
 
-def view(path):
+def view(path, stream=None):
     '''
     decorator for render Template
     
@@ -1010,6 +1465,11 @@ def view(path):
     Traceback (most recent call last):
       ...
     ValueError: Expect return a dict when using @view() decorator.
+    >>> @view('test/view.html', stream=True)
+    ... def hello3():
+    ...     return dict(name='Bob')
+    >>> hello3().stream
+    True
     '''
     def _decorator(func):
         @functools.wraps(func)
@@ -1017,14 +1477,80 @@ def view(path):
             r = func(*args, **kw)
             if isinstance(r, dict):
                 logging.info('[WEB] [return Template]')
-                return Template(path, **r)
+                t = Template(path, **r)
+                if stream is not None:
+                    t.stream = stream
+                return t
             raise ValueError('Expect return a dict when using @view() decorator.')
         return _wrapper
     return _decorator
 
+# define query budget
+
+def query_budget(max_queries):
+    '''
+    decorator for limiting SQL statements issued by a handler, checked only
+    when the request is tracked (always in debug, sampled in production)
+    
+    >>> @query_budget(1)
+    ... def handler():
+    ...     db.current_tracker().record('select * from user where id=%s')
+    ...     db.current_tracker().record('select * from blog where id=%s')
+    ...     return 'ok'
+    >>> with db.tracking(strict=True):
+    ...     handler()
+    Traceback (most recent call last):
+      ...
+    QueryBudgetError: handler() issued 2 queries, budget is 1.
+    '''
+    def _decorator(func):
+        @functools.wraps(func)
+        def _wrapper(*args, **kw):
+            tracker = db.current_tracker()
+            if tracker is None:
+                return func(*args, **kw)
+            start = tracker.count
+            r = func(*args, **kw)
+            used = tracker.count - start
+            if used > max_queries:
+                if tracker.strict:
+                    raise db.QueryBudgetError('%s() issued %d queries, budget is %d.' % (func.__name__, used, max_queries))
+                logging.warning('[WEB] [query budget] [%s() issued %d queries, budget is %d]' % (func.__name__, used, max_queries))
+            return r
+        return _wrapper
+    return _decorator
+
 # define route
 
-_RE_ROUTE = re.compile(r'(\:[a-zA-Z_]\w*)')
+_RE_ROUTE = re.compile(r'(\:[a-zA-Z_]\w*(?:\<[a-z]+\>)?)')
+
+# typed route parameter as (regex, converter), e.g. '/api/blog/:id<int>'
+_ROUTE_TYPES = {
+    'str': (r'[^\/]+', None),
+    'int': (r'\d+', int),
+    'path': (r'.+', None),
+}
+
+def _parse_var(v):
+    '''
+    parse route variable as (name, type)
+    
+    >>> _parse_var(':blog_id')
+    ('blog_id', 'str')
+    >>> _parse_var(':page<int>')
+    ('page', 'int')
+    >>> _parse_var(':page<float>')
+    Traceback (most recent call last):
+      ...
+    ValueError: Unsupported route parameter type: float
+    '''
+    pos = v.find('<')
+    if pos == (-1):
+        return v[1:], 'str'
+    name, kind = v[1:pos], v[pos + 1:-1]
+    if not kind in _ROUTE_TYPES:
+        raise ValueError('Unsupported route parameter type: %s' % kind)
+    return name, kind
 
 def _build_regex(path):
     r'''
@@ -1038,15 +1564,17 @@ def _build_regex(path):
     '^\\/(?P<user>[^\\/]+)\\/(?P<comments>[^\\/]+)\\/list$'
     >>> _build_regex(':id-:pid/:w')
     '^(?P<id>[^\\/]+)\\-(?P<pid>[^\\/]+)\\/(?P<w>[^\\/]+)$'
+    >>> _build_regex('/page/:n<int>/:rest<path>')
+    '^\\/page\\/(?P<n>\\d+)\\/(?P<rest>.+)$'
     '''
     re_list = ['^']
     var_list = []
     is_var = False
     for v in _RE_ROUTE.split(path):
         if is_var:
-            var_name = v[1:]
+            var_name, var_type = _parse_var(v)
             var_list.append(var_name)
-            re_list.append(r'(?P<%s>[^\/]+)' % var_name)
+            re_list.append(r'(?P<%s>%s)' % (var_name, _ROUTE_TYPES[var_type][0]))
         else:
             s = ''
             for ch in v:
@@ -1074,6 +1602,8 @@ class Route(object):
         if not self.is_static:
             self.route = re.compile(_build_regex(self.path))
         self.func = func
+        self.cache = getattr(func, '__cache_response__', None)
+        self.rate_limit = getattr(func, '__rate_limit__', None)
     
     def match(self, url):
         m = self.route.match(url)
@@ -1091,6 +1621,13 @@ class Route(object):
     
     __repr__ = __str__
 
+def _route_decorator(path, method):
+    def _decorator(func):
+        func.__web_route__ = path
+        func.__web_method__ = method
+        return func
+    return _decorator
+
 def get(path):
     '''
     decorator for GET method
@@ -1106,11 +1643,7 @@ def get(path):
     >>> test()
     'ok'
     '''
-    def _decorator(func):
-        func.__web_route__ = path
-        func.__web_method__ = 'GET'
-        return func
-    return _decorator
+    return _route_decorator(path, 'GET')
 
 def post(path):
     '''
@@ -1127,38 +1660,364 @@ def post(path):
     >>> test()
     'ok'
     '''
-    def _decorator(func):
-        func.__web_route__ = path
-        func.__web_method__ = 'POST'
-        return func
-    return _decorator
+    return _route_decorator(path, 'POST')
 
-def _generate_static_file(fpath):
+def put(path):
+    '''
+    decorator for PUT method
+    
+    >>> @put('/test/:id')
+    ... def test():
+    ...     return 'ok'
+    ...
+    >>> test.__web_method__
+    'PUT'
+    '''
+    return _route_decorator(path, 'PUT')
+
+def delete(path):
+    '''
+    decorator for DELETE method
+    
+    >>> @delete('/test/:id')
+    ... def test():
+    ...     return 'ok'
+    ...
+    >>> test.__web_method__
+    'DELETE'
+    '''
+    return _route_decorator(path, 'DELETE')
+
+_RE_FINGERPRINT = re.compile(r'[\.\-][0-9a-fA-F]{8,}\.\w+$')
+_RE_BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def _parse_range(header, size):
+    '''
+    parse single byte range as inclusive (start, end), None if malformed or
+    multiple ranges so the whole file is sent
+    
+    >>> _parse_range('bytes=0-99', 1000)
+    (0, 99)
+    >>> _parse_range('bytes=900-', 1000)
+    (900, 999)
+    >>> _parse_range('bytes=-100', 1000)
+    (900, 999)
+    >>> _parse_range('bytes=500-5000', 1000)
+    (500, 999)
+    >>> _parse_range('bytes=0-1,5-6', 1000)
+    >>> _parse_range('bytes=2000-', 1000)
+    Traceback (most recent call last):
+      ...
+    HttpError: 416 Requested Range Not Satisfiable
+    '''
+    m = _RE_BYTE_RANGE.match(header.strip())
+    if m is None:
+        return None
+    first, last = m.groups()
+    if not first:
+        if not last:
+            return None
+        n = int(last)
+        if n == 0 or size == 0:
+            raise HttpError(416)
+        return max(size - n, 0), size - 1
+    start = int(first)
+    if start >= size:
+        raise HttpError(416)
+    end = int(last) if last else size - 1
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+def _generate_static_file(fpath, offset=0, length=None):
     BLOCK_SIZE = 8192
     with open(fpath, 'rb') as f:
-        block = f.read(BLOCK_SIZE)
-        while block:
+        if offset:
+            f.seek(offset)
+        while length is None or length > 0:
+            block = f.read(BLOCK_SIZE if length is None else min(BLOCK_SIZE, length))
+            if not block:
+                break
+            if length is not None:
+                length = length - len(block)
             yield block
-            block = f.read(BLOCK_SIZE)
 
 class StaticFileRoute(object):
-    def __init__(self):
+    '''
+    serve files under document_root/static with validators, Range requests,
+    precompressed .br/.gz siblings and an in-memory cache of small files, or
+    hand them to nginx by X-Accel-Redirect if accel_prefix is set
+    '''
+    def __init__(self, max_age=3600, memory_limit=65536, cache_size=256, accel_prefix=None):
         self.method = 'GET'
+        self.cache = None
+        self.rate_limit = None
+        self.path = '/static/:file<path>'
         self.route = re.compile('^/static/(.+)$')
-        self.is_static = True
+        self.is_static = False
+        self.max_age = max_age
+        self.memory_limit = memory_limit
+        self.accel_prefix = accel_prefix
+        self._files = ResponseCache(cache_size) if memory_limit else None
     
     def match(self, url):
         if url.startswith('/static/'):
-            return (url[1:],)
+            return (url[8:],)
+        return None
+    
+    def _stat(self, fpath):
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            return None
+        return st if stat.S_ISREG(st.st_mode) else None
+    
+    def _encoding(self, fpath, content_type):
+        '''
+        choose precompressed sibling as (encoding, path, stat) or None
+        '''
+        if not content_type.split(';', 1)[0] in _COMPRESS_TYPES:
+            return None
+        _add_vary(ctx.response, 'Accept-Encoding')
+        accept_encoding = ctx.request.environ.get('HTTP_ACCEPT_ENCODING')
+        encodings = []
+        if _choose_encoding(accept_encoding) == 'br':
+            encodings.append(('br', '.br'))
+        if _choose_encoding(accept_encoding, allow_br=False) == 'gzip':
+            encodings.append(('gzip', '.gz'))
+        for encoding, ext in encodings:
+            st = self._stat(fpath + ext)
+            if st:
+                return encoding, fpath + ext, st
         return None
     
     def __call__(self, *args):
-        fpath = os.path.join(ctx.application.document_root, args[0])
-        if not os.path.isfile(fpath):
+        root = os.path.join(ctx.application.document_root, 'static')
+        fpath = os.path.normpath(os.path.join(root, args[0]))
+        if not fpath.startswith(root + os.sep):
+            raise notfounderror()
+        st = self._stat(fpath)
+        if st is None:
             raise notfounderror()
+        response = ctx.response
         fext = os.path.splitext(fpath)[1]
-        ctx.response.content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')
+        response.content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')
+        if _RE_FINGERPRINT.search(fpath):
+            # name changes with content, never revalidate
+            response.set_header('Cache-Control', 'public, max-age=31536000, immutable')
+        else:
+            response.set_header('Cache-Control', 'public, max-age=%d' % self.max_age)
+        if self.accel_prefix:
+            response.last_modified = st.st_mtime
+            response.set_header('X-Accel-Redirect', self.accel_prefix + fpath[len(root) + 1:].replace(os.sep, '/'))
+            return []
+        etag = '%x-%x' % (int(st.st_mtime), st.st_size)
+        encoded = self._encoding(fpath, response.content_type)
+        check_modified(etag=etag, last_modified=st.st_mtime, weak=False)
+        if encoded:
+            encoding, fpath, st = encoded
+            response.set_header('Content-Encoding', encoding)
+            response.set_etag('%s-%s' % (etag, encoding))
+        else:
+            response.set_header('Accept-Ranges', 'bytes')
+            environ = ctx.request.environ
+            range_header = environ.get('HTTP_RANGE')
+            if range_header and environ.get('HTTP_IF_RANGE', response.etag) == response.etag:
+                try:
+                    r = _parse_range(range_header, st.st_size)
+                except HttpError:
+                    response.set_header('Content-Range', 'bytes */%d' % st.st_size)
+                    raise
+                if r:
+                    start, end = r
+                    response.status = 206
+                    response.set_header('Content-Range', 'bytes %d-%d/%d' % (start, end, st.st_size))
+                    response.set_header('Content-Length', str(end - start + 1))
+                    return _generate_static_file(fpath, start, end - start + 1)
+        response.set_header('Content-Length', str(st.st_size))
+        if self._files is not None and st.st_size <= self.memory_limit:
+            key = (st.st_mtime, st.st_size)
+            entry = self._files.get(fpath)
+            if entry is None or entry[0] != key:
+                with open(fpath, 'rb') as f:
+                    entry = (key, f.read())
+                self._files.put(fpath, entry, 86400, ())
+            return entry[1]
+        file_wrapper = ctx.request.environ.get('wsgi.file_wrapper')
+        if file_wrapper:
+            # let server use sendfile if it can
+            return file_wrapper(open(fpath, 'rb'), 32768)
         return _generate_static_file(fpath)
+    
+    def __str__(self):
+        return 'StaticFileRoute(dynamic,GET,path=%s)' % self.path
+    
+    __repr__ = __str__
+
+# define router
+
+class _SegmentMatcher(object):
+    '''
+    match one path segment of a dynamic route, return list of args or None
+    
+    >>> _SegmentMatcher(':id').match('abc')
+    ['abc']
+    >>> _SegmentMatcher(':id<int>').match('abc')
+    >>> _SegmentMatcher(':id<int>').match('123')
+    [123]
+    >>> _SegmentMatcher(':id-:pid').match('1-2')
+    ['1', '2']
+    '''
+    def __init__(self, segment):
+        self.segment = segment
+        self.catch_all = False
+        parts = _RE_ROUTE.split(segment)
+        if len(parts) == 3 and not parts[0] and not parts[2]:
+            # whole segment is one variable
+            name, kind = _parse_var(parts[1])
+            self.catch_all = kind == 'path'
+            self.kind = kind
+            self.convert = _ROUTE_TYPES[kind][1]
+            self.regex = None
+        else:
+            self.kind = None
+            self.convert = None
+            self.regex = re.compile(_build_regex(segment))
+            self.converts = [ _ROUTE_TYPES[_parse_var(v)[1]][1] for v in parts[1::2] ]
+    
+    def match(self, segment):
+        if self.regex is None:
+            if not segment:
+                return None
+            if self.kind == 'int' and not segment.isdigit():
+                return None
+            return [ self.convert(segment) if self.convert else segment ]
+        m = self.regex.match(segment)
+        if m is None:
+            return None
+        return [ c(v) if c else v for c, v in zip(self.converts, m.groups()) ]
+
+class _RouteNode(object):
+    
+    def __init__(self):
+        self.static = {}
+        self.dynamic = []
+        self.route = None
+    
+    def child(self, segment):
+        if _RE_ROUTE.search(segment) is None:
+            node = self.static.get(segment)
+            if node is None:
+                node = self.static[segment] = _RouteNode()
+            return node
+        for matcher, node in self.dynamic:
+            if matcher.segment == segment:
+                return node
+        matcher = _SegmentMatcher(segment)
+        node = _RouteNode()
+        self.dynamic.append((matcher, node))
+        return node
+    
+    def match(self, segments, i, args):
+        if i == len(segments):
+            return (self.route, args) if self.route else None
+        segment = segments[i]
+        node = self.static.get(segment)
+        if node is not None:
+            r = node.match(segments, i + 1, args)
+            if r:
+                return r
+        for matcher, node in self.dynamic:
+            if matcher.catch_all:
+                rest = '/'.join(segments[i:])
+                if rest and node.route:
+                    return node.route, args + [rest]
+                continue
+            values = matcher.match(segment)
+            if values is not None:
+                r = node.match(segments, i + 1, args + values)
+                if r:
+                    return r
+        return None
+
+class Router(object):
+    '''
+    route table per http method, static paths are looked up in a dict and
+    dynamic paths in a segment tree, so matching costs O(path segments)
+    
+    >>> router = Router()
+    >>> for path in ('/api/blog/list', '/api/blog/:blog_id', '/page/:n<int>', '/static/:file<path>', '/:a-:b/x'):
+    ...     router.add(SimpleDict(method='GET', path=path, is_static=_RE_ROUTE.search(path) is None))
+    >>> router.match('GET', '/api/blog/list')[0].path
+    '/api/blog/list'
+    >>> r, args = router.match('GET', '/api/blog/0012')
+    >>> r.path, args
+    ('/api/blog/:blog_id', ['0012'])
+    >>> router.match('GET', '/page/12')[1]
+    [12]
+    >>> router.match('GET', '/page/abc')
+    >>> router.match('GET', '/static/css/awesome.css')[1]
+    ['css/awesome.css']
+    >>> router.match('GET', '/1-2/x')[1]
+    ['1', '2']
+    >>> router.match('POST', '/api/blog/list')
+    >>> router.match('HEAD', '/api/blog/list')[0].path
+    '/api/blog/list'
+    >>> router.match('PATCH', '/api/blog/list')
+    '''
+    METHODS = ('GET', 'POST', 'HEAD', 'PUT', 'DELETE')
+    
+    def __init__(self):
+        self._static = dict([ (m, {}) for m in Router.METHODS ])
+        self._trees = dict([ (m, _RouteNode()) for m in Router.METHODS ])
+    
+    def add(self, route):
+        if not route.method in self._trees:
+            raise ValueError('Unsupported method: %s' % route.method)
+        if route.is_static:
+            self._static[route.method][route.path] = route
+            return
+        node = self._trees[route.method]
+        for segment in route.path.split('/'):
+            node = node.child(segment)
+        if node.route:
+            logging.warning('[WEB] [route %s overrides %s]' % (route, node.route))
+        node.route = route
+    
+    def match(self, method, path):
+        '''
+        get (route, args) by method and path, None if not found
+        '''
+        table = self._static.get(method)
+        if table is None:
+            return None
+        route = table.get(path)
+        if route:
+            return route, []
+        r = self._trees[method].match(path.split('/'), 0, [])
+        if r is None and method == 'HEAD':
+            # HEAD falls back to GET routes, body is dropped by application
+            return self.match('GET', path)
+        return r
+    
+    def supports(self, method):
+        return method in self._static
+    
+    def routes(self):
+        '''
+        all routes of all methods
+        '''
+        L = []
+        for method in Router.METHODS:
+            L.extend(self._static[method].values())
+            nodes = [self._trees[method]]
+            while nodes:
+                node = nodes.pop()
+                if node.route:
+                    L.append(node.route)
+                nodes.extend(node.static.values())
+                nodes.extend([ n for matcher, n in node.dynamic ])
+        return L
 
 # define RESTful API
 
@@ -1247,8 +2106,160 @@ def _page_dump(obj):
         }
     raise TypeError('%s is not JSON serializable' % obj)
 
+def _json_encoder(name):
+    '''
+    get encode function of json library by name, output is str
+    
+    >>> _json_encoder('json')({'a': [1, None]})
+    '{"a": [1, null]}'
+    >>> _json_encoder('yaml')
+    Traceback (most recent call last):
+      ...
+    ValueError: Unknown json encoder: yaml
+    '''
+    if name == 'ujson':
+        import ujson
+        return functools.partial(ujson.dumps, ensure_ascii=True, escape_forward_slashes=False)
+    if name == 'simplejson':
+        import simplejson
+        return simplejson.JSONEncoder().encode
+    if name == 'json':
+        return json.JSONEncoder().encode
+    raise ValueError('Unknown json encoder: %s' % name)
+
+def _default_json_encoder():
+    # prefer C-accelerated libraries when installed
+    for name in ('ujson', 'simplejson'):
+        try:
+            return _json_encoder(name)
+        except ImportError:
+            pass
+    return _json_encoder('json')
+
+_json_encode = _default_json_encoder()
+
+def set_json_encoder(encoder):
+    '''
+    set encoder for @api responses by name (ujson, simplejson, json) or as a
+    function which takes plain dicts, lists and scalars and returns str
+    '''
+    global _json_encode
+    _json_encode = _json_encoder(encoder) if isinstance(encoder, basestring) else encoder
+
+class _ModelPlan(object):
+    '''
+    serialization plan of a model class, compiled once: sensitive fields are
+    dropped and lazily loaded fields are resolved on a plain dict copy
+    '''
+    def __init__(self, cls):
+        mappings = cls.__mappings__
+        self.hidden = tuple([ k for k, f in mappings.iteritems() if getattr(f, 'sensitive', False) ])
+        self.lazy = tuple([ k for k in getattr(cls, '__compressed__', ()) if not k in self.hidden ])
+    
+    def dump(self, m):
+        d = dict(m)
+        for k in self.hidden:
+            d.pop(k, None)
+        for k in self.lazy:
+            if k in d:
+                d[k] = m[k]
+        return d
+
+_model_plans = {}
+
+def _to_json_data(obj):
+    '''
+    convert api result to plain json data
+    
+    >>> class Account(dict):
+    ...     __mappings__ = {'name': SimpleDict(), 'password': SimpleDict(sensitive=True)}
+    >>> a = Account(name='Bob', password='secret', extra=1)
+    >>> sorted(_to_json_data(dict(accounts=[a]))['accounts'][0].items())
+    [('extra', 1), ('name', 'Bob')]
+    >>> a['password']
+    'secret'
+    >>> _to_json_data((Page(25, 2), None))[0]['page_count']
+    3
+    >>> sorted(_to_json_data(dict(a=SimpleDict(u=a)))['a']['u'])
+    ['extra', 'name']
+    '''
+    t = type(obj)
+    plan = _model_plans.get(t)
+    if plan is None:
+        if hasattr(t, '__mappings__'):
+            plan = _model_plans[t] = _ModelPlan(t)
+        elif isinstance(obj, dict):
+            return dict([ (k, _to_json_data(v)) for k, v in obj.iteritems() ])
+        elif isinstance(obj, (list, tuple)):
+            return [ _to_json_data(x) for x in obj ]
+        else:
+            return _page_dump(obj) if t is Page else obj
+    return plan.dump(obj)
+
 def restful_api_dumps(obj):
-    return json.dumps(obj, default=_page_dump)
+    r = _json_encode(_to_json_data(obj))
+    if isinstance(r, unicode):
+        r = r.encode('utf-8')
+    return r
+
+class JsonStream(object):
+    '''
+    @api result written row by row as NDJSON or a JSON array through the
+    WSGI iterable, rows are batched into chunks of about 8 KiB
+    
+    >>> body = ''.join(JsonStream(iter([dict(id=1), dict(id=2)]), 'ndjson'))
+    >>> [ json.loads(line) for line in body.splitlines() ]
+    [{u'id': 1}, {u'id': 2}]
+    >>> json.loads(''.join(JsonStream(iter([dict(id=1), dict(id=2)]), 'array')))
+    [{u'id': 1}, {u'id': 2}]
+    >>> JsonStream([], 'xml')
+    Traceback (most recent call last):
+      ...
+    APIValueError: Invalid stream format.
+    '''
+    FORMATS = {
+        'ndjson': 'application/x-ndjson',
+        'array': 'application/json',
+    }
+    
+    def __init__(self, rows, format='ndjson'):
+        if not format in JsonStream.FORMATS:
+            raise APIValueError('stream', 'Invalid stream format.')
+        self.rows = rows
+        self.format = format
+        self.content_type = JsonStream.FORMATS[format]
+    
+    def __iter__(self):
+        ndjson = self.format == 'ndjson'
+        L = [] if ndjson else ['[']
+        size = 0
+        try:
+            for n, row in enumerate(self.rows):
+                s = restful_api_dumps(row)
+                if ndjson:
+                    L.append(s)
+                    L.append('\n')
+                else:
+                    if n:
+                        L.append(', ')
+                    L.append(s)
+                size = size + len(s)
+                if size >= _STREAM_CHUNK_SIZE:
+                    yield ''.join(L)
+                    L = []
+                    size = 0
+            if not ndjson:
+                L.append(']')
+            yield ''.join(L)
+        except Exception, e:
+            # status is already sent, truncated body tells client it failed
+            logging.exception(e)
+        finally:
+            self.close()
+    
+    def close(self):
+        if hasattr(self.rows, 'close'):
+            self.rows.close()
 
 def api(func):
     '''
@@ -1262,16 +2273,300 @@ def api(func):
     @functools.wraps(func)
     def _wrapper(*args, **kw):
         try:
-            r = restful_api_dumps(func(*args, **kw))
+            r = func(*args, **kw)
+            if isinstance(r, JsonStream):
+                ctx.response.content_type = r.content_type
+                return r
+            r = restful_api_dumps(r)
         except APIError, e:
             r = json.dumps(dict(error=e.error, data=e.data, message=e.message))
         except Exception, e:
+            if isinstance(e, HttpError) and e.status.startswith('304'):
+                # check_modified() answered the conditional request
+                raise
             logging.exception(e)
             r = json.dumps(dict(error='internalerror', data=e.__class__.__name__, message=e.message))
         ctx.response.content_type = 'application/json'
         return r
     return _wrapper
 
+# define response cache
+
+def cache_response(ttl=60, vary=(), tags=()):
+    '''
+    decorator for caching whole responses of anonymous GET requests, keyed
+    by path, query string and the vary headers, tags (or a function taking
+    route args and returning tags) are used by invalidate_cache()
+    
+    >>> @cache_response(ttl=300, tags=lambda blog_id: ['blog:%s' % blog_id])
+    ... @get('/blog/:blog_id')
+    ... def blog(blog_id):
+    ...     return 'ok'
+    >>> blog.__cache_response__.ttl
+    300
+    >>> blog.__cache_response__.tags('001')
+    ['blog:001']
+    '''
+    def _decorator(func):
+        func.__cache_response__ = SimpleDict(ttl=ttl, vary=[ h.upper() for h in vary ], tags=tags)
+        return func
+    return _decorator
+
+# define rate limit
+
+def rate_limit(rate, burst=1, key='ip'):
+    '''
+    decorator limiting requests of each client to route by token bucket,
+    rate as "count/s|m|h|d" refills burst tokens, key 'ip' checks before
+    interceptors run, 'user' after them by id of request.user, falling back
+    to ip for anonymous requests
+    
+    >>> @rate_limit('10/m', burst=5)
+    ... @post('/api/user/authenticate')
+    ... def authenticate():
+    ...     return 'ok'
+    >>> authenticate.__rate_limit__.burst
+    5
+    >>> rate_limit('1/s', key='session')
+    Traceback (most recent call last):
+      ...
+    ValueError: Invalid rate limit key: session
+    '''
+    if not key in ('ip', 'user'):
+        raise ValueError('Invalid rate limit key: %s' % key)
+    policy = SimpleDict(rate=parse_rate(rate), burst=burst, key=key)
+    def _decorator(func):
+        func.__rate_limit__ = policy
+        return func
+    return _decorator
+
+def _client_ip(environ, trusted_proxies):
+    '''
+    address of client, X-Real-IP is trusted only from proxies
+    
+    >>> _client_ip({'REMOTE_ADDR': '127.0.0.1', 'HTTP_X_REAL_IP': '10.0.0.1'}, ('127.0.0.1',))
+    '10.0.0.1'
+    >>> _client_ip({'REMOTE_ADDR': '10.0.0.2', 'HTTP_X_REAL_IP': '10.0.0.1'}, ('127.0.0.1',))
+    '10.0.0.2'
+    '''
+    addr = environ.get('REMOTE_ADDR', '')
+    # requests over unix socket have no address
+    if not addr or addr in trusted_proxies:
+        return environ.get('HTTP_X_REAL_IP') or addr
+    return addr
+
+def invalidate_cache(*tags):
+    '''
+    drop cached responses by tags in current application
+    '''
+    ctx.application.response_cache.invalidate(*tags)
+
+class ResponseCache(object):
+    '''
+    in-process LRU cache of (status, headers, body) with ttl and tags, the
+    tag generations are checked on get so an invalidation made by another
+    worker through shared generations also drops the entry here
+    
+    >>> c = ResponseCache(2)
+    >>> c.put('/a', ('200 OK', {}, 'A'), 60, ['blogs'])
+    >>> c.put('/b', ('200 OK', {}, 'B'), 60, ['blog:1'])
+    >>> c.get('/a')[2]
+    'A'
+    >>> c.put('/c', ('200 OK', {}, 'C'), 60, [])
+    >>> c.get('/b')
+    >>> c.invalidate('blogs')
+    >>> c.get('/a')
+    >>> c.put('/d', ('200 OK', {}, 'D'), 0, [])
+    >>> c.get('/d')
+    >>> gen = c.generation(['blog:2'])
+    >>> c.put('/e', ('200 OK', {}, 'E'), 60, ['blog:2'], gen)
+    >>> c.get('/e')[2]
+    'E'
+    >>> c._generations.bump('blog:2') # as another worker does
+    >>> c.get('/e')
+    >>> c.put('/f', ('200 OK', {}, 'F'), 60, ['blog:2'], gen) # rendered before invalidation
+    >>> c.get('/f')
+    '''
+    def __init__(self, max_entries=1000, generations=None):
+        self._max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+        self._generations = MemoryGenerations() if generations is None else generations
+    
+    def generation(self, tags):
+        '''
+        snapshot of tag generations, taken before rendering an entry
+        '''
+        return self._generations.snapshot(tags)
+    
+    def get(self, key):
+        with self._lock:
+            item = self._entries.pop(key, None)
+            if item is None:
+                return None
+            expires, tags, gen, entry = item
+            if expires <= time.time() or (tags and self._generations.snapshot(tags) != gen):
+                self._drop(key, tags)
+                return None
+            # reinsert as most recently used
+            self._entries[key] = item
+            return entry
+    
+    def put(self, key, entry, ttl, tags, gen=None):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._drop(key, old[1])
+            if gen is None:
+                gen = self._generations.snapshot(tags)
+            self._entries[key] = (time.time() + ttl, tags, gen, entry)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self._max_entries:
+                k, item = self._entries.popitem(last=False)
+                self._drop(k, item[1])
+    
+    def invalidate(self, *tags):
+        self._generations.bump(*tags)
+        with self._lock:
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    item = self._entries.pop(key, None)
+                    if item:
+                        self._drop(key, item[1])
+    
+    def _drop(self, key, tags):
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+def _cache_body(cache, pending, response, body):
+    '''
+    store rendered body into cache, iterable bodies are stored once fully sent
+    '''
+    key, ttl, tags, gen = pending
+    headers = dict(response._headers)
+    if isinstance(body, str):
+        cache.put(key, (response.status, headers, body), ttl, tags, gen)
+        return body
+    def _generate():
+        L = []
+        for chunk in body:
+            L.append(chunk)
+            yield chunk
+        cache.put(key, (response.status, headers, ''.join(L)), ttl, tags, gen)
+    return _generate()
+
+# define response compression
+
+_COMPRESS_TYPES = (
+    'text/html',
+    'text/css',
+    'text/plain',
+    'text/xml',
+    'application/json',
+    'application/x-ndjson',
+    'application/javascript',
+    'application/x-javascript',
+    'application/xml',
+    'image/svg+xml',
+)
+
+def _import_brotli():
+    try:
+        import brotli
+        return brotli
+    except ImportError:
+        return None
+
+def _choose_encoding(accept_encoding, allow_br=True):
+    '''
+    choose content coding from Accept-Encoding, None for identity
+    
+    >>> _choose_encoding('gzip, deflate, br')
+    'br'
+    >>> _choose_encoding('gzip, deflate, br', allow_br=False)
+    'gzip'
+    >>> _choose_encoding('gzip;q=0, deflate')
+    >>> _choose_encoding('br;q=0, *')
+    'gzip'
+    >>> _choose_encoding('')
+    '''
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, sep, params = item.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    wildcard = accepted.get('*', 0.0)
+    if allow_br and accepted.get('br', wildcard) > 0:
+        return 'br'
+    if accepted.get('gzip', accepted.get('x-gzip', wildcard)) > 0:
+        return 'gzip'
+    return None
+
+def _add_vary(response, header):
+    '''
+    append header to Vary of response
+    
+    >>> r = Response()
+    >>> _add_vary(r, 'Accept-Encoding')
+    >>> _add_vary(r, 'Accept-Encoding')
+    >>> _add_vary(r, 'Cookie')
+    >>> r.header('Vary')
+    'Accept-Encoding, Cookie'
+    '''
+    vary = response.header('VARY')
+    if not vary:
+        response.set_header('VARY', header)
+    elif header.lower() not in [ v.strip().lower() for v in vary.split(',') ]:
+        response.set_header('VARY', '%s, %s' % (vary, header))
+
+def _compress(body, encoding, level):
+    '''
+    compress str body at once, or iterable body chunk by chunk with a sync
+    flush after each chunk so streamed pages are not held back
+    
+    >>> import gzip
+    >>> data = _compress('hello' * 100, 'gzip', 6)
+    >>> gzip.GzipFile(fileobj=StringIO(data)).read() == 'hello' * 100
+    True
+    >>> data = ''.join(_compress(iter(['hello', ' world']), 'gzip', 6))
+    >>> gzip.GzipFile(fileobj=StringIO(data)).read()
+    'hello world'
+    '''
+    if encoding == 'br':
+        c = _import_brotli().Compressor(quality=level)
+        process, flush, finish = c.process, c.flush, c.finish
+    else:
+        # wbits 16 + 15 writes gzip header and trailer
+        c = zlib.compressobj(level, zlib.DEFLATED, 31)
+        process, flush, finish = c.compress, lambda: c.flush(zlib.Z_SYNC_FLUSH), c.flush
+    if isinstance(body, str):
+        return process(body) + finish()
+    def _generate():
+        try:
+            for chunk in body:
+                data = process(chunk) + flush()
+                if data:
+                    yield data
+            yield finish()
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+    return _generate()
+
 # define interceptor
 
 _RE_INTERCEPTOR_STARTS_WITH = re.compile(r'^([^\*\?]+)\*?$')
@@ -1280,10 +2575,14 @@ _RE_INTERCEPTOR_ENDS_WITH = re.compile(r'^\*([^\*\?]+)$')
 def _build_pattern_fn(pattern):
     m = _RE_INTERCEPTOR_STARTS_WITH.match(pattern)
     if m:
-        return lambda p: p.startswith(m.group(1))
+        fn = lambda p: p.startswith(m.group(1))
+        fn.starts_with = m.group(1)
+        return fn
     m = _RE_INTERCEPTOR_ENDS_WITH.match(pattern)
     if m:
-        return lambda p: p.endswith(m.group(1))
+        fn = lambda p: p.endswith(m.group(1))
+        fn.ends_with = m.group(1)
+        return fn
     raise ValueError('Invalid pattern definition in interceptor.')
 
 def interceptor(pattern='/'):
@@ -1351,9 +2650,129 @@ def _build_interceptor_chain(last_fn, *interceptors):
         fn = _build_interceptor_fn(f, fn)
     return fn
 
-# global threading.local object, store request and response
+def _interceptor_applies(func, path):
+    '''
+    True if interceptor applies to every request path matching route path,
+    False if to none, None if it depends on the request path
+    
+    >>> @interceptor('/manage/')
+    ... def f1(next):
+    ...     return next()
+    >>> _interceptor_applies(f1, '/manage/blog/:id'), _interceptor_applies(f1, '/api/blog/:id'), _interceptor_applies(f1, '/:page')
+    (True, False, None)
+    >>> _interceptor_applies(f1, '/manage/'), _interceptor_applies(f1, '/manage')
+    (True, False)
+    >>> @interceptor('*.json')
+    ... def f2(next):
+    ...     return next()
+    >>> _interceptor_applies(f2, '/api/:id.json'), _interceptor_applies(f2, '/api/:id/list'), _interceptor_applies(f2, '/static/:file<path>')
+    (True, False, None)
+    '''
+    predicate = func.__interceptor__
+    parts = _RE_ROUTE.split(path)
+    if len(parts) == 1:
+        return bool(predicate(path))
+    if hasattr(predicate, 'starts_with'):
+        pattern, literal = predicate.starts_with, parts[0]
+        if literal.startswith(pattern):
+            return True
+        return None if pattern.startswith(literal) else False
+    if hasattr(predicate, 'ends_with'):
+        pattern, literal = predicate.ends_with, parts[-1]
+        if literal.endswith(pattern):
+            return True
+        return None if pattern.endswith(literal) else False
+    return None
+
+def _build_route_chain(last_fn, path, interceptors):
+    '''
+    build chain of interceptors applying to route path, only those whose
+    pattern cannot be decided from the route path check request path
+    
+    >>> def target():
+    ...     return 'target'
+    >>> @interceptor('/api/')
+    ... def f1(next):
+    ...     return 'f1 ' + next()
+    >>> @interceptor('/manage/')
+    ... def f2(next):
+    ...     return 'f2 ' + next()
+    >>> _build_route_chain(target, '/api/blog/:id', [f1, f2])()
+    'f1 target'
+    >>> _build_route_chain(target, '/manage/', [f1, f2])()
+    'f2 target'
+    >>> _build_route_chain(target, '/:page', [f1, f2]) is target
+    False
+    >>> _build_route_chain(target, '/blog/:id', [f1, f2]) is target
+    True
+    '''
+    fn = last_fn
+    for f in reversed(interceptors):
+        applies = _interceptor_applies(f, path)
+        if applies:
+            fn = functools.partial(f, fn)
+        elif applies is None:
+            fn = _build_interceptor_fn(f, fn)
+    return fn
+
+# global context object, store application, request and response of current
+# thread, or of current greenlet in gevent mode
+
+class _RequestContext(object):
+    
+    def defer(self, fn, *args, **kw):
+        '''
+        run fn(*args, **kw) on the background pool of application once the
+        response of current request is built, only if it succeeded
+        '''
+        response = self.response
+        if response._deferred is None:
+            response._deferred = []
+        response._deferred.append((fn, args, kw))
+
+ctx = ContextLocal(_RequestContext)
 
-ctx = threading.local()
+_blocking_pool = None
+_blocking_pool_lock = threading.Lock()
+
+def _get_blocking_pool(size):
+    global _blocking_pool
+    with _blocking_pool_lock:
+        if _blocking_pool is None:
+            from gevent.threadpool import ThreadPool
+            _blocking_pool = ThreadPool(size)
+        return _blocking_pool
+
+def blocking(func):
+    '''
+    decorator for handlers calling code that cannot yield to other greenlets,
+    such as C extensions doing I/O or long CPU work: in gevent mode the call
+    runs with current ctx in a bounded pool of native threads, otherwise it
+    is called directly
+    
+    >>> @blocking
+    ... def test():
+    ...     return 'ok'
+    >>> test()
+    'ok'
+    '''
+    @functools.wraps(func)
+    def _wrapper(*args, **kw):
+        if not green():
+            return func(*args, **kw)
+        application, request, response = ctx.application, ctx.request, ctx.response
+        def _call():
+            ctx.application = application
+            ctx.request = request
+            ctx.response = response
+            try:
+                return func(*args, **kw)
+            finally:
+                del ctx.application
+                del ctx.request
+                del ctx.response
+        return _get_blocking_pool(application.blocking_pool_size).apply(_call)
+    return _wrapper
 
 # define wsgi application
 
@@ -1379,6 +2798,105 @@ def _load_module(module_name):
     m = __import__(from_module, globals(), locals(), [import_module])
     return getattr(m, import_module)
 
+def profile_request():
+    '''
+    profile current request until its response is built, call it only for
+    authorized users, return False if application has no profile_dir
+    
+    >>> ctx.application = SimpleDict(profiler=None)
+    >>> profile_request()
+    False
+    >>> del ctx.application
+    '''
+    profiler = ctx.application.profiler
+    if profiler is None or ctx.response._profile:
+        return False
+    ctx.response._profile = (profiler.start(), time.time())
+    return True
+
+_METRIC_METHODS = frozenset(['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'])
+
+class _HttpMetrics(object):
+    '''
+    request, template and SQL metrics in the default registry, a directory
+    makes pre-forked workers write their own file so expose sums all workers
+    '''
+    def __init__(self, directory=None):
+        self.registry = metrics.REGISTRY
+        if directory:
+            self.registry.configure(directory)
+        self.requests = self.registry.counter('http_requests_total', 'Requests by route, method and status.', ('route', 'method', 'status'))
+        self.latency = self.registry.histogram('http_request_duration_seconds', 'Time until the response starts by route.', ('route',))
+        self.in_flight = self.registry.gauge('http_requests_in_flight', 'Requests being handled.')
+        self.render = self.registry.histogram('template_render_seconds', 'Template render time by template.', ('template',))
+        self.sql = self.registry.histogram('db_query_seconds', 'SQL statement time by statement.', ('statement',))
+        self.shed = self.registry.counter('http_requests_shed_total', 'Requests rejected by admission control by route class.', ('class',))
+        self.limited = self.registry.counter('http_requests_limited_total', 'Requests rejected by rate limit by route.', ('route',))
+        self.tasks = self.registry.gauge('background_tasks_queued', 'Deferred tasks waiting for the pool.')
+    
+    def observe_sql(self, sql, seconds):
+        statement = sql.split(None, 1)[0].lower() if sql.strip() else 'unknown'
+        self.sql.labels(statement).observe(seconds)
+    
+    def wrap(self, wsgi):
+        '''
+        count request by matched route pattern, so labels stay bounded
+        '''
+        def fn_wsgi(env, start_response):
+            status = []
+            def fn_start_response(s, headers, exc_info=None):
+                status.append(s)
+                if exc_info:
+                    return start_response(s, headers, exc_info)
+                return start_response(s, headers)
+            self.in_flight.inc()
+            start = time.time()
+            try:
+                return wsgi(env, fn_start_response)
+            finally:
+                route = env.get('transwarp.route', 'unmatched')
+                method = env.get('REQUEST_METHOD', '')
+                self.latency.labels(route).observe(time.time() - start)
+                self.requests.labels(route, method if method in _METRIC_METHODS else 'other', status[0][:3] if status else '500').inc()
+                self.in_flight.dec()
+        return fn_wsgi
+
+class _ClosingBody(object):
+    '''
+    streamed body which calls on_close once when the server closes it, so
+    work done while the body is iterated still counts for the request
+    
+    >>> released = []
+    >>> b = _ClosingBody(iter(['a', 'b']), lambda: released.append(True))
+    >>> list(b), released
+    (['a', 'b'], [])
+    >>> b.close()
+    >>> b.close()
+    >>> released
+    [True]
+    '''
+    __slots__ = ('_body', '_on_close')
+    
+    def __init__(self, body, on_close):
+        self._body = body
+        self._on_close = on_close
+    
+    def __iter__(self):
+        return iter(self._body)
+    
+    def close(self):
+        on_close, self._on_close = self._on_close, None
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            if on_close:
+                on_close()
+
+def _default_admission_priority(request):
+    # writes are admitted before reads under load
+    return request.request_method not in ('GET', 'HEAD')
+
 class WSGIApplication(object):
     
     def __init__(self, document_root=None, **kw):
@@ -1386,10 +2904,42 @@ class WSGIApplication(object):
         self._document_root = document_root
         self._template_engine = None
         self._interceptors = []
-        self._get_static = {}
-        self._get_dynamic = []
-        self._post_static = {}
-        self._post_dynamic = []
+        self._router = Router()
+        self._query_sample_rate = kw.get('query_sample_rate', 0.0)
+        self._query_repeat_limit = kw.get('query_repeat_limit', 10)
+        self._max_body_size = kw.get('max_body_size', None)
+        self._session_cookie = kw.get('session_cookie', None)
+        generations = SharedGenerations(kw['response_cache_file']) if kw.get('response_cache_file') else None
+        self._response_cache = ResponseCache(kw.get('response_cache_size', 1000), generations)
+        self._compress_level = kw.get('compress_level', 6)
+        self._compress_min_size = kw.get('compress_min_size', 1024)
+        self._compress_types = frozenset(kw.get('compress_types', _COMPRESS_TYPES))
+        self._brotli_level = kw.get('brotli_level', 5)
+        self._brotli = _import_brotli() if self._brotli_level else None
+        if kw.get('json_encoder'):
+            set_json_encoder(kw['json_encoder'])
+        self._blocking_pool_size = kw.get('blocking_pool_size', 10)
+        self._serve_static = kw.get('serve_static', False)
+        self._static_options = dict(
+            max_age=kw.get('static_max_age', 3600),
+            memory_limit=kw.get('static_memory_limit', 65536),
+            cache_size=kw.get('static_cache_size', 256),
+            accel_prefix=kw.get('static_accel_prefix', None))
+        self._metrics = _HttpMetrics(kw.get('metrics_dir', None)) if kw.get('metrics', False) else None
+        self._metrics_path = kw.get('metrics_path', '/metrics')
+        self._profiler = Profiler(kw['profile_dir'], kw.get('profile_keep', 50)) if kw.get('profile_dir') else None
+        self._admission = None
+        if kw.get('admission_limits'):
+            options = dict(queue_size=kw.get('admission_queue_size', None), timeout=kw.get('admission_timeout', 0.5), adaptive=kw.get('admission_adaptive', True))
+            if kw.get('admission_classes'):
+                options['classes'] = kw['admission_classes']
+            self._admission = AdmissionController(kw['admission_limits'], **options)
+        self._admission_priority = _default_admission_priority
+        self._admission_retry_after = kw.get('admission_retry_after', 1)
+        self._rate_buckets = SharedBuckets(kw['ratelimit_file'], kw.get('ratelimit_slots', 65536)) if kw.get('ratelimit_file') else MemoryBuckets()
+        self._trusted_proxies = frozenset(kw.get('trusted_proxies', ('127.0.0.1', '::1')))
+        self._tasks = TaskPool(kw.get('task_pool_size', 4), kw.get('task_queue_size', 1000), kw.get('task_retries', 2),
+            drain_timeout=kw.get('task_drain_timeout', 10), on_depth=self._metrics.tasks.set if self._metrics else None)
     
     def _check_not_running(self):
         if self._running:
@@ -1404,6 +2954,30 @@ class WSGIApplication(object):
         self._check_not_running()
         self._template_engine = engine
     
+    @property
+    def response_cache(self):
+        return self._response_cache
+    
+    @property
+    def profiler(self):
+        return self._profiler
+    
+    @property
+    def tasks(self):
+        return self._tasks
+    
+    @property
+    def admission_priority(self):
+        return self._admission_priority
+    
+    @admission_priority.setter
+    def admission_priority(self, fn):
+        '''
+        set fn(request) returning True for requests admitted first under load
+        '''
+        self._check_not_running()
+        self._admission_priority = fn
+    
     def add_interceptor(self, func):
         self._check_not_running()
         self._interceptors.append(func)
@@ -1412,16 +2986,7 @@ class WSGIApplication(object):
     def add_url(self, func):
         self._check_not_running()
         route = Route(func)
-        if route.is_static:
-            if route.method == 'GET':
-                self._get_static[route.path] = route
-            if route.method == 'POST':
-                self._post_static[route.path] = route
-        else:
-            if route.method == 'GET':
-                self._get_dynamic.append(route)
-            if route.method == 'POST':
-                self._post_dynamic.append(route)
+        self._router.add(route)
         logging.info('[WEB] [add route: %s]' % str(route))
     
     def add_module(self, mod):
@@ -1435,56 +3000,218 @@ class WSGIApplication(object):
     
     def get_wsgi_application(self, debug=False):
         self._check_not_running()
-        if debug:
-            self._get_dynamic.append(StaticFileRoute())
+        if debug or self._serve_static:
+            self._router.add(StaticFileRoute(**self._static_options))
+        if self._metrics:
+            registry = self._metrics.registry
+            @get(self._metrics_path)
+            def fn_metrics():
+                # scraped on the app port, requests proxied by nginx are refused
+                env = ctx.request.environ
+                if 'HTTP_X_REAL_IP' in env or 'HTTP_X_FORWARDED_FOR' in env:
+                    raise notfounderror()
+                ctx.response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                ctx.response.set_header('Cache-Control', 'no-cache')
+                return registry.expose()
+            self._router.add(Route(fn_metrics))
+            db.add_observer(self._metrics.observe_sql)
         self._running = True
         
-        _application = SimpleDict(document_root=self._document_root)
+        _application = SimpleDict(document_root=self._document_root, response_cache=self._response_cache, blocking_pool_size=self._blocking_pool_size, profiler=self._profiler)
         
-        def fn_route():
-            request_method = ctx.request.request_method
-            path_info = ctx.request.path_info
-            if request_method == 'GET':
-                fn = self._get_static.get(path_info, None)
-                if fn:
-                    return fn()
-                for fn in self._get_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
-                raise notfounderror()
-            if request_method == 'POST':
-                fn = self._post_static.get(path_info, None)
-                if fn:
-                    return fn()
-                for fn in self._post_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
+        def fn_cached(route, args):
+            request = ctx.request
+            if self._session_cookie:
+                if request.cookie(self._session_cookie):
+                    return route(*args)
+            elif 'HTTP_COOKIE' in request.environ:
+                return route(*args)
+            policy = route.cache
+            key = '%s?%s' % (request.path_info, request.query_string)
+            if policy.vary:
+                key = '%s|%s' % (key, '|'.join([ request.header(h, u'').encode('utf-8') for h in policy.vary ]))
+            entry = self._response_cache.get(key)
+            if entry:
+                status, headers, body = entry
+                ctx.response.status = status
+                ctx.response._headers.update(headers)
+                return body
+            tags = policy.tags(*args) if callable(policy.tags) else list(policy.tags)
+            ctx.response._cache_pending = (key, policy.ttl, tags, self._response_cache.generation(tags))
+            return route(*args)
+        
+        def fn_target(route):
+            def _call():
+                args = ctx.request.environ['wsgiorg.routing_args'][0]
+                if route.cache and ctx.request.request_method == 'GET':
+                    return fn_cached(route, args)
+                return route(*args)
+            return _call
+        
+        def fn_unmatched():
+            if self._router.supports(ctx.request.request_method):
                 raise notfounderror()
             raise badrequesterror()
         
-        fn_exec = _build_interceptor_chain(fn_route, *self._interceptors)
+        # token bucket of route policy per client, 429 when it is empty
+        def fn_limited(fn, route):
+            policy = route.rate_limit
+            def _call():
+                request = ctx.request
+                user = getattr(request, 'user', None) if policy.key == 'user' else None
+                client = 'user:%s' % user.id if user else _client_ip(request.environ, self._trusted_proxies)
+                wait = self._rate_buckets.take(('%s %s|%s' % (route.method, route.path, client)).encode('utf-8'), policy.rate, policy.burst)
+                if wait:
+                    if self._metrics:
+                        self._metrics.limited.labels(route.path).inc()
+                    ctx.response.set_header('Retry-After', str(int(math.ceil(wait))))
+                    raise HttpError(429)
+                return fn()
+            return _call
+        
+        def fn_route_chain(route):
+            policy = route.rate_limit
+            fn = fn_target(route)
+            if policy and policy.key == 'user':
+                fn = fn_limited(fn, route)
+            fn = _build_route_chain(fn, route.path, self._interceptors)
+            if policy and policy.key == 'ip':
+                # rejected before interceptors do any DB work
+                fn = fn_limited(fn, route)
+            return fn
+        
+        # interceptors are resolved against route paths once, only paths
+        # without route check every interceptor pattern
+        route_chains = dict([ (route, fn_route_chain(route)) for route in self._router.routes() ])
+        fn_unmatched_chain = _build_interceptor_chain(fn_unmatched, *self._interceptors)
+        
+        def fn_chain():
+            request = ctx.request
+            r = self._router.match(request.request_method, request.path_info)
+            if r is None:
+                return fn_unmatched_chain()
+            route, args = r
+            env = request.environ
+            env['transwarp.route'] = route.path
+            env['wsgiorg.routing_args'] = (args, {})
+            return route_chains[route]()
+        
+        def fn_encoding(response, body):
+            # handler that set Content-Length sends exact bytes
+            if not self._compress_level or response.header('CONTENT-ENCODING') or response.header('CONTENT-LENGTH'):
+                return None
+            content_type = (response.content_type or '').split(';', 1)[0].strip().lower()
+            if not content_type in self._compress_types:
+                return None
+            if isinstance(body, str):
+                if len(body) < self._compress_min_size:
+                    return None
+            elif isinstance(body, (list, tuple)) or hasattr(body, 'read'):
+                return None
+            _add_vary(response, 'Accept-Encoding')
+            return _choose_encoding(ctx.request.environ.get('HTTP_ACCEPT_ENCODING'), self._brotli is not None)
+        
+        def fn_exec():
+            # track statements of every request in debug, sample them in production
+            if debug or (self._query_sample_rate and random.random() < self._query_sample_rate):
+                with db.tracking(self._query_repeat_limit, strict=debug):
+                    return fn_chain()
+            return fn_chain()
+        
+        def fn_admit(request):
+            # limiter to release after response, None if class has no limit
+            path = request.path_info
+            if self._metrics and path == self._metrics_path:
+                return None
+            limiter = self._admission.limiter(path)
+            if limiter is None or limiter.acquire(self._admission_priority(request)):
+                return limiter
+            if self._metrics:
+                self._metrics.shed.labels(self._admission.classify(path)).inc()
+            ctx.response.set_header('Retry-After', str(self._admission_retry_after))
+            raise HttpError(503)
+        
+        def fn_release(limiter, admitted_at):
+            limiter.release(time.time() - admitted_at)
+        
+        def fn_submit_deferred(response):
+            if response._deferred:
+                for fn, args, kw in response._deferred:
+                    self._tasks.submit(fn, args, kw)
         
         def wsgi(env, start_response):
             ctx.application = _application
-            ctx.request = Request(env)
+            ctx.request = Request(env, self._max_body_size)
             _response = ctx.response = Response()
+            limiter = None
             try:
+                if self._max_body_size and (_content_length(env) or 0) > self._max_body_size:
+                    # reject before any interceptor or handler runs
+                    raise HttpError(413)
+                if self._admission:
+                    limiter = fn_admit(ctx.request)
+                    admitted_at = time.time()
                 r = fn_exec()
-                if isinstance(r, Template):
-                    r = self._template_engine(r.template_name, r.model)
+                request_method = ctx.request.request_method
+                if isinstance(r, Template) and request_method != 'HEAD':
+                    stream = r.stream if r.stream is not None else self._template_engine.stream
+                    if stream:
+                        r = self._template_engine.generate(r.template_name, r.model)
+                    else:
+                        name, _st = r.template_name, time.time()
+                        r = self._template_engine(name, r.model)
+                        if self._metrics:
+                            self._metrics.render.labels(name).observe(time.time() - _st)
                 if isinstance(r, unicode):
                     r = r.encode('utf-8')
                 if r is None:
                     r = []
+                pending = _response._cache_pending
+                if pending and _response.status_code == 200 and _response._cookies is None:
+                    # cache identity body without validators, they are added per request
+                    r = _cache_body(self._response_cache, pending, _response, r)
+                if _response.status_code == 200 and request_method in ('GET', 'HEAD'):
+                    encoding = fn_encoding(_response, r)
+                    if isinstance(r, str) and _response.etag is None:
+                        # buffered body gets a strong ETag unless handler set validators
+                        _response.set_etag(hashlib.md5(r).hexdigest())
+                    if encoding:
+                        etag = _response.etag
+                        if etag and not etag.startswith('W/'):
+                            _response.set_header('ETAG', '%s-%s"' % (etag[:-1], encoding))
+                        _response.set_header('CONTENT-ENCODING', encoding)
+                    if _is_not_modified(env, _response.etag, _response.last_modified):
+                        raise HttpError(304)
+                    if encoding:
+                        r = _compress(r, encoding, self._brotli_level if encoding == 'br' else self._compress_level)
+                if request_method == 'HEAD':
+                    if isinstance(r, str):
+                        _response.set_header('Content-Length', str(len(r)))
+                    elif hasattr(r, 'close'):
+                        r.close()
+                    r = []
+                if isinstance(r, str):
+                    # servers iterate the body, a bare str goes out byte by byte
+                    r = [r]
+                if _response.status_code < 400:
+                    fn_submit_deferred(_response)
                 start_response(_response.status, _response.headers)
+                if limiter and not isinstance(r, (list, tuple)):
+                    # streamed body renders while server iterates it, keep slot until close
+                    r = _ClosingBody(r, functools.partial(fn_release, limiter, admitted_at))
+                    limiter = None
                 return r
             except RedirectError, e:
+                fn_submit_deferred(_response)
                 _response.set_header('Location', e.location)
                 start_response(e.status, _response.headers)
                 return []
             except HttpError, e:
+                if e.status.startswith('304'):
+                    _response.unset_header('Content-Type')
+                    _response.unset_header('Content-Encoding')
+                    start_response(e.status, _response.headers)
+                    return []
                 start_response(e.status, _response.headers)
                 return ['<html><body><h1>', e.status, '</h1></body></html>']
             except Exception, e:
@@ -1503,15 +3230,50 @@ class WSGIApplication(object):
                     stacks.replace('<', '&lt;').replace('>', '&gt;'),
                     '</pre></div></body></html>']
             finally:
+                if limiter:
+                    fn_release(limiter, admitted_at)
+                profile = _response._profile
+                if profile:
+                    # streamed bodies are profiled until the handler returns
+                    label = '%s %s' % (env.get('REQUEST_METHOD', ''), env.get('transwarp.route', env.get('PATH_INFO', '')))
+                    self._profiler.save(profile[0], label, time.time() - profile[1])
                 del ctx.application
                 del ctx.request
                 del ctx.response
         
+        if self._metrics:
+            wsgi = self._metrics.wrap(wsgi)
+        # servers call it before the process exits
+        wsgi.shutdown = self._tasks.drain
         return wsgi
     
-    def run(self, port=9000, host='127.0.0.1'):
-        from wsgiref.simple_server import make_server
+    def run(self, port=9000, host='127.0.0.1', server='wsgiref', pool_size=1000, **kw):
+        '''
+        run development server, server='gevent' serves each request in a
+        greenlet, at most pool_size at once, after gevent.monkey.patch_all(),
+        server='prefork' runs production server with workers, threads,
+        unix_socket, reuse_port and keepalive options, both run without
+        debug unless debug=True is passed
+        '''
         logging.info('[WEB] [application (%s) will start at %s:%s...]' % (self._document_root, host, port))
+        if server == 'prefork':
+            from server import serve
+            threads = kw.get('threads', 8)
+            if self._admission:
+                for name, limit in self._admission.limits.iteritems():
+                    if limit >= threads:
+                        # excess requests wait in the listen backlog, never in the limiter
+                        logging.warning('[WEB] [admission limit %s=%d is not below %d threads per worker, it never sheds]' % (name, limit, threads))
+            serve(self.get_wsgi_application(debug=kw.pop('debug', False)), host, port, **kw)
+            return
+        if server == 'gevent':
+            if not green():
+                raise RuntimeError('Call gevent.monkey.patch_all() before running gevent server.')
+            from gevent.pool import Pool
+            from gevent.pywsgi import WSGIServer
+            WSGIServer((host, port), self.get_wsgi_application(debug=kw.pop('debug', False)), spawn=Pool(pool_size)).serve_forever()
+            return
+        from wsgiref.simple_server import make_server
         server = make_server(host, port, self.get_wsgi_application(debug=True))
         server.serve_forever()
 
@@ -7,43 +7,54 @@ module for url manager
 
 import hashlib
 import logging
+import os
 import re
-import time
+import urlparse
 
 import markdown2
 
 from models import User, Blog, Comment
 from config import configs
-from transwarp.web import ctx, get, post, Page, api, view, interceptor
+from transwarp.web import ctx, get, post, Page, api, view, interceptor, query_budget, cache_response, invalidate_cache, check_modified, JsonStream, profile_request, rate_limit
 from transwarp.web import seeothererror, notfounderror, APIError, APIValueError, APIResourceNotFoundError, APIPermissionError
+from transwarp.orm import ConflictError
+from transwarp.session import SessionCodec, RevocationCache
 
 # cookie handler
 
-_COOKIE_NAME = 'awesession'
-_COOKIE_KEY = configs.session.secret
+_COOKIE_NAME = configs.web.session_cookie
 
-def _make_signed_cookie(id, password, max_age):
-    # build cookie string by: id-expires-md5
-    expires = str(int(time.time() + (max_age or 86400)))
-    L = [ id, expires, hashlib.md5('%s-%s-%s-%s' % (id, password, expires, _COOKIE_KEY)).hexdigest() ]
-    return '-'.join(L)
+def _session_secrets():
+    secrets = dict(configs.session.retired_secrets)
+    secrets[configs.session.key_version] = configs.session.secret
+    return secrets
+
+_SESSIONS = SessionCodec(_session_secrets(), configs.session.key_version, configs.session.max_age)
+
+def _session_stamp(user):
+    # changes when password or admin flag changes, revoking older sessions
+    return '%s-%s' % (user.password, bool(user.admin))
+
+def _load_session_stamp(user_id):
+    user = User.get(user_id)
+    return None if user is None else _session_stamp(user)
+
+_revocations = RevocationCache(configs.session.revoke_ttl, _load_session_stamp) if configs.session.revoke_ttl else None
+
+def _make_signed_cookie(user, max_age):
+    # user fields needed by handlers, signed so no lookup is needed per request
+    data = dict(id=user.id, name=user.name, image=user.image, admin=bool(user.admin), st=_SESSIONS.fingerprint(_session_stamp(user)))
+    return _SESSIONS.encode(data, max_age)
 
 def _parse_signed_cookie(cookie_str):
-    try:
-        L = cookie_str.split('-')
-        if len(L) != 3:
-            return None
-        user_id, expires, md5 = L
-        if int(expires) < time.time():
-            return None
-        user = User.get(user_id)
-        if user is None:
-            return None
-        if md5 != hashlib.md5('%s-%s-%s-%s' % (user.id, user.password, expires, _COOKIE_KEY)).hexdigest():
-            return None
-        return user
-    except:
+    session = _SESSIONS.decode(cookie_str)
+    if session is None:
         return None
+    if _revocations is not None:
+        stamp = _revocations.get(session.id)
+        if stamp is None or _SESSIONS.fingerprint(stamp, session.kv) != session.st:
+            return None
+    return session
 
 # define pagination
 
@@ -63,16 +74,34 @@ def _get_blog_by_page():
 
 # interceptor
 
+def admission_priority(request):
+    # writes and admins are admitted first when the site is overloaded
+    if request.request_method not in ('GET', 'HEAD'):
+        return True
+    cookie = request.cookie(_COOKIE_NAME)
+    if not cookie:
+        return False
+    # classify without touching the database, a revoked admin loses priority
+    # once user_interceptor has cached the new stamp
+    session = _SESSIONS.decode(cookie)
+    if session is None or not session.admin:
+        return False
+    if _revocations is not None:
+        stamp = _revocations.peek(session.id)
+        if stamp is not None and _SESSIONS.fingerprint(stamp, session.kv) != session.st:
+            return False
+    return True
+
 @interceptor('/')
 def user_interceptor(next):
     logging.info('[APP] [try to bind user from session cookie...]')
     user = None
-    cookie = ctx.request.cookies.get(_COOKIE_NAME)
+    cookie = ctx.request.cookie(_COOKIE_NAME)
     if cookie:
         logging.info('[APP] [parse session cookie...]')
         user = _parse_signed_cookie(cookie)
         if user:
-            logging.info('[APP] [success to bind user <%s> to session]' % user.email)
+            logging.info('[APP] [success to bind user <%s> to session]' % user.id)
     ctx.request.user = user
     return next()
 
@@ -83,6 +112,17 @@ def manage_interceptor(next):
         return next()
     raise seeothererror('/user/signin')
 
+@interceptor('/')
+def profile_interceptor(next):
+    # ?__profile=1 or X-Profile header, honored for admins only, the
+    # query string is read directly so the body is not parsed here
+    qs = ctx.request.query_string
+    if ('__profile' in qs and urlparse.parse_qs(qs).get('__profile')) or ctx.request.header('X-Profile'):
+        user = ctx.request.user
+        if user and user.admin:
+            profile_request()
+    return next()
+
 # view
 
 def _check_admin():
@@ -91,6 +131,18 @@ def _check_admin():
         return
     raise APIPermissionError('No Permission.')
 
+def _export(model):
+    '''
+    stream whole table for ?stream=ndjson|array, None for normal paging
+    '''
+    format = ctx.request.get('stream', '')
+    if not format:
+        return None
+    _check_admin()
+    return JsonStream(model.iter_by(), format)
+
+@cache_response(ttl=60, tags=('blogs',))
+@query_budget(2)
 @view('index.html')
 @get('/')
 def index():
@@ -99,7 +151,9 @@ def index():
     blogs = Blog.find_by('order by created_at desc limit ?,?', page.offset, page.limit)
     return dict(page=page, blogs=blogs, user=ctx.request.user)
 
-@view('blog.html')
+@cache_response(ttl=300, tags=lambda blog_id: ['blog:%s' % blog_id])
+@query_budget(2)
+@view('blog.html', stream=True)
 @get('/blog/:blog_id')
 def blog(blog_id):
     blog = Blog.get(blog_id)
@@ -156,6 +210,25 @@ def manage_blog_update(blog_id):
 def manage_comment_list():
     return dict(page_index=_get_page_index(), user=ctx.request.user)
 
+@view('manage_profile_list.html')
+@get('/manage/profiles')
+def manage_profile_list():
+    profiler = ctx.application.profiler
+    return dict(profiles=profiler.captures() if profiler else [], user=ctx.request.user)
+
+@get('/manage/profiles/:name')
+def manage_profile_file(name):
+    # collapsed stacks for flamegraph.pl, ?format=prof for pstats
+    profiler = ctx.application.profiler
+    ext = 'prof' if ctx.request.get('format', '') == 'prof' else 'collapsed'
+    path = profiler.path(name, ext) if profiler else None
+    if path is None or not os.path.isfile(path):
+        raise notfounderror()
+    ctx.response.content_type = 'text/plain' if ext == 'collapsed' else 'application/octet-stream'
+    with open(path, 'rb') as f:
+        return f.read()
+
+@rate_limit('10/m', burst=5)
 @api
 @post('/api/user/authenticate')
 def api_user_authenticate():
@@ -170,14 +243,14 @@ def api_user_authenticate():
         raise APIError('auth:failed', 'password', 'Invalid password.')
     # make session cookie
     max_age = 604800 if remember == 'true' else None
-    cookie = _make_signed_cookie(user.id, user.password, max_age)
+    cookie = _make_signed_cookie(user, max_age)
     ctx.response.set_cookie(_COOKIE_NAME, cookie, max_age=max_age)
-    user.password = '******'
     return user
 
 _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
 _RE_MD5 = re.compile(r'^[0-9a-f]{32}$')
 
+@rate_limit('5/h', burst=3)
 @api
 @post('/api/user/create')
 def api_user_create():
@@ -198,19 +271,21 @@ def api_user_create():
     user = User(name=name, email=email, password=password, image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email).hexdigest())
     user.insert()
     # make session cookie:
-    cookie = _make_signed_cookie(user.id, user.password, None)
+    cookie = _make_signed_cookie(user, None)
     ctx.response.set_cookie(_COOKIE_NAME, cookie)
     logging.info('[APP] [create a user ok]')
     return user
 
+@query_budget(2)
 @api
 @get('/api/user/list')
 def api_user_list():
+    export = _export(User)
+    if export:
+        return export
     total = User.count_all()
     page = Page(total, _get_page_index())
     users = User.find_by('order by created_at desc limit ?,?', page.offset, page.limit)
-    for u in users:
-        u.password = '******'
     return dict(users=users, page=page)
 
 @api
@@ -219,11 +294,16 @@ def api_blog(blog_id):
     blog = Blog.get(blog_id)
     if blog is None:
         raise APIResourceNotFoundError('Blog')
+    check_modified(etag='%s-%s' % (blog.id, blog.version))
     return blog
 
+@query_budget(2)
 @api
 @get('/api/blog/list')
 def api_blog_list():
+    export = _export(Blog)
+    if export:
+        return export
     format = ctx.request.get('format', '')
     total = Blog.count_all()
     page = Page(total, _get_page_index())
@@ -251,6 +331,7 @@ def api_blog_create():
     user = ctx.request.user
     blog = Blog(user_id=user.id, user_name=user.name, title=title, summary=summary, content=content)
     blog.insert()
+    invalidate_cache('blogs')
     logging.info('[APP] [create a blog ok]')
     return blog
 
@@ -259,7 +340,7 @@ def api_blog_create():
 def api_blog_update(blog_id):
     logging.info('[APP] [try to update a blog...]')
     _check_admin()
-    i = ctx.request.input(title='', summary='', content='')
+    i = ctx.request.input(title='', summary='', content='', version='')
     title = i.title.strip()
     summary = i.summary.strip()
     content = i.content.strip()
@@ -272,10 +353,20 @@ def api_blog_update(blog_id):
     blog = Blog.get(blog_id)
     if blog is None:
         raise APIResourceNotFoundError('Blog')
+    if i.version:
+        # update only if nobody else saved the blog since the editor loaded it
+        try:
+            blog.version = int(i.version)
+        except ValueError:
+            raise APIValueError('version')
     blog.title = title
     blog.summary = summary
     blog.content = content
-    blog.update()
+    try:
+        blog.update()
+    except ConflictError:
+        raise APIError('update:conflict', 'version', 'Blog was modified by others, please reload.')
+    invalidate_cache('blogs', 'blog:%s' % blog.id)
     logging.info('[APP] [update a blog ok]')
     return blog
 
@@ -288,17 +379,23 @@ def api_blog_delete(blog_id):
     if blog is None:
         raise APIResourceNotFoundError('Blog')
     blog.delete()
+    invalidate_cache('blogs', 'blog:%s' % blog.id)
     logging.info('[APP] [delete a blog ok]')
     return None
 
+@query_budget(2)
 @api
 @get('/api/comment/list')
 def api_comment_list():
+    export = _export(Comment)
+    if export:
+        return export
     total = Comment.count_all()
     page = Page(total, _get_page_index())
     comments = Comment.find_by('order by created_at desc limit ?,?', page.offset, page.limit)
     return dict(comments=comments, page=page)
 
+@rate_limit('6/m', burst=3, key='user')
 @api
 @post('/api/comment/create/:blog_id')
 def api_comment_create(blog_id):
@@ -314,6 +411,7 @@ def api_comment_create(blog_id):
         raise APIValueError('content')
     comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content)
     comment.insert()
+    invalidate_cache('blog:%s' % blog.id)
     logging.info('[APP] [create a comment ok]')
     return dict(comment=comment)
 
@@ -326,6 +424,7 @@ def api_comment_delete(comment_id):
     if comment is None:
         raise notfounderror()
     comment.delete()
+    invalidate_cache('blog:%s' % comment.blog_id)
     logging.info('[APP] [delete a comment ok]')
     return dict(id=comment_id)
 
@@ -7,6 +7,7 @@ module for wsgi application
 
 from datetime import datetime
 import os
+import sys
 import time
 
 import logging
@@ -33,22 +34,43 @@ def datetime_filter(t):
 # inin database
 db.create_engine(**configs.db)
 
+_TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+_COMPILED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates_compiled')
+
 # init template engine
-template_engine = Jinja2TemplateEngine(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
+if __name__ == '__main__' and not sys.argv[1:]:
+    # development server, reload changed templates
+    template_engine = Jinja2TemplateEngine(_TEMPLATE_DIR)
+else:
+    template_engine = Jinja2TemplateEngine(_TEMPLATE_DIR, cache_dir=configs.template.cache_dir, compiled_dir=_COMPILED_DIR, auto_reload=False)
 template_engine.add_filter('datetime', datetime_filter)
 
 # init wsgi application
-wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)))
+wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)), **configs.web)
 wsgi.template_engine = template_engine
 
 # add url module to wsgi
 import urls
 wsgi.add_interceptor(urls.user_interceptor)
 wsgi.add_interceptor(urls.manage_interceptor)
+wsgi.add_interceptor(urls.profile_interceptor)
+wsgi.admission_priority = urls.admission_priority
 wsgi.add_module(urls)
 
 # run application
 if __name__ == '__main__':
-    wsgi.run()
+    if sys.argv[1:] == ['compile']:
+        # build step: precompile templates for production
+        template_engine.compile(_COMPILED_DIR)
+    elif sys.argv[1:] == ['serve']:
+        # production: application is loaded before workers are forked
+        wsgi.run(server='prefork', **configs.server)
+    elif sys.argv[1:] == ['gevent']:
+        # ctx and db context follow greenlets once patched
+        from gevent import monkey
+        monkey.patch_all()
+        wsgi.run(server='gevent')
+    else:
+        wsgi.run()
 else:
     application = wsgi.get_wsgi_application()